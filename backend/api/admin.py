@@ -45,6 +45,7 @@ class CommandAdmin(admin.ModelAdmin):
     list_filter = ('status', 'name')
     search_fields = ('name', 'device__device_id')
     readonly_fields = ('result_formatted', 'code_preview', 'input_data_preview')
+    list_select_related = ('device',)
 
     def device_info(self, obj):
         return f"{obj.device.device_type} ({obj.device.device_id})"
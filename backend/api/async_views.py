@@ -0,0 +1,489 @@
+"""
+Async variants of the device-facing endpoints, served under /api/async/.
+
+They behave like their counterparts in views.py but never block the event
+loop: database access goes through Django's async ORM (or a thread for the
+claim transaction) and crypto runs in worker threads. Run the project under
+an ASGI server (e.g. `uvicorn backend.asgi:application`) so one process can
+hold many concurrent long polls and slow device connections. The event
+streams need it: under WSGI they are refused with 503 and clients poll.
+"""
+import asyncio
+import functools
+import json
+import logging
+import time
+import uuid
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+from .models import Device, AuthorizationToken, Command, ActionParameter
+from .crypto import decrypt_with_private_key, encrypt_with_public_key
+from .device_cache import device_cache
+from .dispatch import command_notifier
+from .events import event_broadcaster, publish_command_status, publish_device_status
+from .framing import DEVICE_ID_HEADER, is_binary_request, wants_binary_response, binary_response
+from .heartbeats import heartbeat_buffer
+from .scheduler import capability_index
+from .views import _negotiate_session_channel, _negotiate_framing, _parse_poll_args, _take_pending_commands
+
+logger = logging.getLogger(__name__)
+
+# Header carrying the session-key proof that opens a device's command stream
+STREAM_AUTH_HEADER = 'X-Device-Auth'
+
+
+def async_view(*methods):
+    """Mark an async endpoint: CSRF-exempt like the DRF views, limited to `methods`"""
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return HttpResponseNotAllowed(methods)
+            return await view(request, *args, **kwargs)
+
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+def _can_stream(request):
+    """
+    Whether the request came in through an ASGI server. WSGI drains a
+    streaming response before sending it, so an endless event stream would
+    never reach the client (and the commands it claims would be lost).
+    """
+    return isinstance(request, ASGIRequest)
+
+
+def in_thread(func):
+    """Run CPU-bound crypto in a worker thread instead of on the event loop"""
+    return sync_to_async(func, thread_sensitive=False)
+
+
+async def _action_table(capabilities):
+    """Parameter definitions of the given actions, keyed by action name"""
+    return {
+        action.action_name: {
+            'parameters': action.parameters,
+            'description': action.description
+        }
+        async for action in ActionParameter.objects.filter(action_name__in=capabilities)
+    }
+
+
+@async_view('POST')
+async def device_heartbeat(request, device_id):
+    """Update the device's last_seen timestamp (heartbeat mechanism)"""
+    try:
+        device = await device_cache.aget(device_id)
+        if device is None:
+            return JsonResponse({'error': 'Device not found'}, status=404)
+
+        # Verify the device identity when the heartbeat carries encrypted data
+        if is_binary_request(request):
+            frame, encrypted_data = request.body, None
+        else:
+            frame, encrypted_data = None, json.loads(request.body or b'{}').get('data')
+        if frame or encrypted_data:
+            try:
+                device, _ = await device_cache.adecrypt(device, frame, encrypted_data)
+            except Exception as e:
+                logger.warning(f"Error decrypting heartbeat data: {str(e)}")
+                return JsonResponse({'error': 'Authentication failed'}, status=403)
+
+        # If previously inactive, reactivate the device right away
+        if not device.is_active:
+            now = timezone.now()
+            await Device.objects.filter(pk=device.pk).aupdate(is_active=True, last_seen=now, updated_at=now)
+            await device_cache.ainvalidate(device_id)
+            publish_device_status(device_id, True, now)
+            logger.info(f"Device reactivated via heartbeat: {device_id}")
+        else:
+            await heartbeat_buffer.arecord(device.pk)
+
+        return JsonResponse({'status': 'ok', 'active': True})
+    except Exception as e:
+        logger.error(f"Error processing heartbeat: {str(e)}")
+        return JsonResponse({'error': 'Heartbeat failed'}, status=500)
+
+
+@async_view('GET')
+async def get_pending_commands(request, device_id):
+    """Get pending commands for a device, long polling with ?wait=<seconds>
+
+    Waiting costs a suspended coroutine rather than a request thread.
+    """
+    try:
+        try:
+            wait, limit = _parse_poll_args(request.GET)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid wait or limit value'}, status=400)
+
+        device = await device_cache.aget_active(device_id)
+        if device is None:
+            return JsonResponse({'error': 'Device not found'}, status=404)
+
+        await heartbeat_buffer.arecord(device.pk)
+
+        # The claim needs a transaction, which the async ORM does not offer
+        take_pending_commands = sync_to_async(_take_pending_commands)
+
+        # Listen before the first query so a command created in between still wakes us up
+        async with command_notifier.alisten(device.pk) as command_queued:
+            command_list = await take_pending_commands(device.pk, limit)
+
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + wait
+            while not command_list:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+
+                # Commands queued by another server process don't notify us,
+                # so re-check the database periodically as well
+                try:
+                    await asyncio.wait_for(
+                        command_queued.wait(),
+                        min(remaining, settings.COMMAND_LONG_POLL_RECHECK_INTERVAL)
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                command_queued.clear()
+                command_list = await take_pending_commands(device.pk, limit)
+
+        command_data = {
+            'commands': command_list,
+            'timestamp': timezone.now().isoformat()
+        }
+        if wants_binary_response(request):
+            frame = await in_thread(device.cipher.seal)(command_data)
+            return binary_response(frame, headers={'X-Long-Poll-Wait': str(wait)})
+
+        encrypted_data = await in_thread(device.cipher.encrypt)(command_data)
+        return JsonResponse({'data': encrypted_data, 'wait': wait})
+    except Exception as e:
+        logger.error(f"Error getting pending commands: {str(e)}")
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+def _sse(event, data, event_id=None):
+    if event_id is not None:
+        return f'id: {event_id}\nevent: {event}\ndata: {data}\n\n'
+    return f'event: {event}\ndata: {data}\n\n'
+
+
+async def _command_events(device):
+    """
+    Push the device's commands as server-sent events as soon as they are queued.
+
+    Commands are claimed exactly like a poll would, so a device falling back
+    to polling never sees them twice. A comment line is sent at every re-check
+    to keep proxies from closing the idle connection. The stream ends when the
+    device is deregistered or starts a new session.
+    """
+    take_pending_commands = sync_to_async(_take_pending_commands)
+
+    async with command_notifier.alisten(device.pk) as command_queued:
+        yield ': connected\n\n'
+
+        while True:
+            command_list = await take_pending_commands(device.pk, settings.COMMAND_CLAIM_BATCH_SIZE)
+            if command_list:
+                encrypted_data = await in_thread(device.cipher.encrypt)({
+                    'commands': command_list,
+                    'timestamp': timezone.now().isoformat()
+                })
+                yield _sse('commands', encrypted_data)
+                continue
+
+            # An open stream counts as a sign of life
+            await heartbeat_buffer.arecord(device.pk)
+
+            try:
+                await asyncio.wait_for(command_queued.wait(), settings.COMMAND_LONG_POLL_RECHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                current = await device_cache.aget_active(device.device_id)
+                if current is None or current.session_key != device.session_key:
+                    logger.info(f"Closing command stream of {device.device_id}: session ended")
+                    return
+                yield ': keepalive\n\n'
+            command_queued.clear()
+
+
+@async_view('GET')
+async def command_stream(request, device_id):
+    """Server-sent event stream pushing new commands to a device
+
+    The device proves it holds the session key with an X-Device-Auth header:
+    its session cipher applied to {"deviceId", "timestamp"}. Results still go
+    back through update_command_status, and pending-commands remains
+    available as a polling fallback.
+    """
+    if not _can_stream(request):
+        return JsonResponse({'error': 'Command stream requires an ASGI server, use pending-commands'}, status=503)
+
+    device = await device_cache.aget_active(device_id)
+    if device is None:
+        return JsonResponse({'error': 'Device not found'}, status=404)
+
+    try:
+        device, proof = await device_cache.adecrypt(device, encrypted_data=request.headers.get(STREAM_AUTH_HEADER, ''))
+        if not device.is_active:
+            raise ValueError('Device is not active')
+        fresh = abs(time.time() - float(proof.get('timestamp', 0))) <= settings.COMMAND_STREAM_AUTH_MAX_AGE
+        if proof.get('deviceId') != device_id or not fresh:
+            raise ValueError('Stale or foreign stream credentials')
+    except Exception as e:
+        logger.warning(f"Rejected command stream for {device_id}: {str(e)}")
+        return JsonResponse({'error': 'Authentication failed'}, status=403)
+
+    response = StreamingHttpResponse(_command_events(device), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Don't let nginx hold events back
+    return response
+
+
+@async_view('POST')
+async def update_command_status(request, command_id):
+    """Update the status and result of a command (called by device)"""
+    try:
+        if is_binary_request(request):
+            device_id = request.headers.get(DEVICE_ID_HEADER)
+            frame, encrypted_data = request.body, None
+        else:
+            data = json.loads(request.body)
+            device_id = data.get('deviceId')
+            frame, encrypted_data = None, data.get('data')
+
+        if not device_id or not (encrypted_data or frame):
+            return JsonResponse({'error': 'Missing required fields'}, status=400)
+
+        device = await device_cache.aget_active(device_id)
+        if device is None:
+            return JsonResponse({'error': 'Device not found'}, status=404)
+
+        try:
+            device, result_data = await device_cache.adecrypt(device, frame, encrypted_data)
+        except Exception as e:
+            logger.warning(f"Error decrypting command result: {str(e)}")
+            return JsonResponse({'error': 'Authentication failed'}, status=403)
+        if not device.is_active:
+            return JsonResponse({'error': 'Device not found'}, status=404)
+
+        command_status = result_data.get('status', 'completed')
+        now = await Command.objects.arecord_result(command_id, device.pk, command_status, result_data)
+        if now is None:
+            return JsonResponse({'error': 'Command not found'}, status=404)
+        publish_command_status(command_id, command_status, now, result_data)
+
+        await heartbeat_buffer.arecord(device.pk)
+
+        logger.info(f"Command {command_id} updated to {command_status}")
+
+        return JsonResponse({'status': 'Command updated'})
+    except Exception as e:
+        logger.error(f"Update command error: {str(e)}")
+        return JsonResponse({'error': 'Error updating command'}, status=500)
+
+
+@async_view('POST')
+async def register_device(request):
+    """Register a new device using an authorization token"""
+    try:
+        data = json.loads(request.body)
+        encrypted_data = data.get('data')
+
+        if not encrypted_data:
+            return JsonResponse({'error': 'Missing encrypted data'}, status=400)
+
+        # RSA decryption is the expensive part of registration; keep it off the loop
+        try:
+            registration_data = await in_thread(decrypt_with_private_key)(encrypted_data)
+        except Exception:
+            return JsonResponse({'error': 'Invalid encrypted data'}, status=400)
+
+        device_info = registration_data.get('deviceInfo', {})
+        auth_token = registration_data.get('authToken')
+
+        try:
+            token = await AuthorizationToken.objects.aget(token=auth_token)
+            if not token.is_valid:
+                return JsonResponse({'error': 'Invalid or expired token'}, status=403)
+        except AuthorizationToken.DoesNotExist:
+            return JsonResponse({'error': 'Invalid token'}, status=403)
+
+        device_id = device_info.get('deviceId')
+        public_key = device_info.get('publicKey')
+        metadata = device_info.get('metadata', {})
+        capabilities = device_info.get('operations', [])
+
+        session_key = uuid.uuid4().hex + uuid.uuid4().hex  # 64 bytes (32 hex chars * 2)
+        hybrid = registration_data.get('responseEnvelope') == 'hybrid'
+        session_channel = _negotiate_session_channel(registration_data.get('sessionChannels'), hybrid)
+
+        device, created = await Device.objects.aupdate_or_create(
+            device_id=device_id,
+            defaults={
+                'public_key': public_key,
+                'session_key': session_key,
+                'session_channel': session_channel,
+                'device_type': metadata.get('type', 'unknown'),
+                'capabilities': capabilities,
+                'metadata': metadata,
+                'is_active': True
+            }
+        )
+        await device_cache.ainvalidate(device_id)
+        capability_index.add(device.pk, capabilities)
+        publish_device_status(device_id, True, device.last_seen)
+
+        # Mark the token as used if this is a new device
+        if created:
+            token.is_used = True
+            await token.asave(update_fields=['is_used'])
+
+        response_data = {
+            'sessionKey': session_key,
+            'message': 'Registration successful',
+            'serverTime': timezone.now().isoformat()
+        }
+        if hybrid:
+            response_data['sessionChannel'] = session_channel
+            response_data['framing'] = _negotiate_framing(registration_data.get('framings'), hybrid)
+            response_data['actions'] = await _action_table(capabilities)
+
+        encrypted_response = await in_thread(encrypt_with_public_key)(response_data, public_key, hybrid=hybrid)
+
+        logger.info(f"Device registered: {device_id} ({metadata.get('type')})")
+        return JsonResponse(encrypted_response, safe=False)
+
+    except Exception as e:
+        logger.error(f"Registration error: {str(e)}")
+        return JsonResponse({'error': 'Registration failed'}, status=500)
+
+
+@async_view('POST')
+async def reconnect_device(request):
+    """Reconnect a previously registered device"""
+    try:
+        data = json.loads(request.body)
+        device_id = data.get('deviceId')
+        public_key_pem = data.get('publicKey')
+
+        if not device_id or not public_key_pem:
+            return JsonResponse({'error': 'Missing required fields'}, status=400)
+
+        try:
+            device = await Device.objects.aget(device_id=device_id)
+        except Device.DoesNotExist:
+            return JsonResponse({'error': 'Device not found', 'action': 'register'}, status=404)
+
+        if device.public_key != public_key_pem:
+            return JsonResponse({'error': 'Authentication failed'}, status=403)
+
+        session_key = uuid.uuid4().hex + uuid.uuid4().hex  # 64 bytes
+        hybrid = data.get('responseEnvelope') == 'hybrid'
+
+        device.session_key = session_key
+        device.session_channel = _negotiate_session_channel(data.get('sessionChannels'), hybrid)
+        device.is_active = True
+        await device.asave(update_fields=['session_key', 'session_channel', 'is_active', 'last_seen', 'updated_at'])
+        await device_cache.ainvalidate(device_id)
+        publish_device_status(device_id, True, device.last_seen)
+
+        logger.info(f"Device reconnected and marked active: {device_id}")
+
+        response_data = {
+            'sessionKey': session_key,
+            'message': 'Reconnection successful',
+            'serverTime': timezone.now().isoformat()
+        }
+        if hybrid:
+            response_data['sessionChannel'] = device.session_channel
+            response_data['framing'] = _negotiate_framing(data.get('framings'), hybrid)
+            response_data['actions'] = await _action_table(device.capabilities)
+
+        encrypted_response = await in_thread(encrypt_with_public_key)(response_data, device.public_key, hybrid=hybrid)
+
+        return JsonResponse(encrypted_response, safe=False)
+
+    except Exception as e:
+        logger.error(f"Reconnection error: {str(e)}")
+        return JsonResponse({'error': 'Reconnection failed'}, status=500)
+
+
+async def _dashboard_user(request):
+    """The user of the dashboard's JWT, passed as ?token= since EventSource cannot send headers"""
+    authentication = JWTAuthentication()
+    raw_token = request.GET.get('token') or authentication.get_raw_token(authentication.get_header(request) or b'')
+    if not raw_token:
+        raise InvalidToken('No token provided')
+    validated_token = authentication.get_validated_token(raw_token)
+    return await sync_to_async(authentication.get_user)(validated_token)
+
+
+async def _dashboard_events(last_event_id):
+    """
+    Relay broadcast device and command changes as server-sent events.
+
+    A 'resync' event tells the client to reload its lists: sent when the
+    events it missed while disconnected are gone, or when it fell behind.
+    """
+    async with event_broadcaster.subscribe(last_event_id) as (queue, missed, subscriber):
+        yield 'retry: 3000\n\n'
+
+        if missed is None:
+            yield _sse('resync', '{}')
+        else:
+            for event_id, event_type, data in missed:
+                yield _sse(event_type, json.dumps(data), event_id)
+
+        while True:
+            try:
+                event_id, event_type, data = await asyncio.wait_for(
+                    queue.get(), settings.DASHBOARD_EVENTS_KEEPALIVE
+                )
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+
+            if subscriber.overflowed:
+                while not queue.empty():
+                    queue.get_nowait()
+                subscriber.overflowed = False
+                yield _sse('resync', '{}')
+                continue
+
+            yield _sse(event_type, json.dumps(data), event_id)
+
+
+@async_view('GET')
+async def dashboard_events(request):
+    """Server-sent event feed of device and command status changes for the dashboard
+
+    Replaces frequent full-list polling: the dashboard loads its lists once,
+    applies the 'device' and 'command' events on top and refreshes through
+    cheap ?since= deltas. Only this process's events are relayed.
+    """
+    if not _can_stream(request):
+        return JsonResponse({'error': 'Event feed requires an ASGI server'}, status=503)
+
+    try:
+        user = await _dashboard_user(request)
+    except (InvalidToken, AuthenticationFailed) as e:
+        return JsonResponse({'error': str(e)}, status=401)
+
+    response = StreamingHttpResponse(
+        _dashboard_events(request.headers.get('Last-Event-ID')),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Don't let nginx hold events back
+    logger.debug(f"Dashboard event stream opened by {user}")
+    return response
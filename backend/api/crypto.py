@@ -1,10 +1,21 @@
 import os
+import atexit
 import json
 import base64
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.backends import default_backend
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 import logging
 
 # Configure logging
@@ -13,14 +24,43 @@ logger = logging.getLogger(__name__)
 
 # Helper functions for encryption/decryption
 
-def load_server_keys():
-    """Load server keys from files or generate if not present"""
-    private_key_path = 'server_private_key.pem'
-    public_key_path = 'server_public_key.pem'
+def _generate_server_key():
+    return rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=2048,
+        backend=default_backend()
+    )
+
 
+def load_server_keys():
+    """
+    Load the server key pair as configured in settings.
+
+    SERVER_PRIVATE_KEY_PEM supplies a pre-generated key directly,
+    SERVER_KEY_IN_MEMORY generates a throwaway key that is never written
+    (for tests), and otherwise the key is read from SERVER_PRIVATE_KEY_PATH,
+    generating and saving a new pair there if it does not exist yet.
+    """
     try:
+        if settings.SERVER_PRIVATE_KEY_PEM:
+            private_key = serialization.load_pem_private_key(
+                settings.SERVER_PRIVATE_KEY_PEM.encode(),
+                password=None,
+                backend=default_backend()
+            )
+            logger.info("Loaded server key from settings")
+            return private_key, private_key.public_key()
+
+        if settings.SERVER_KEY_IN_MEMORY:
+            private_key = _generate_server_key()
+            logger.info("Generated in-memory server key")
+            return private_key, private_key.public_key()
+
+        private_key_path = settings.SERVER_PRIVATE_KEY_PATH
+        public_key_path = settings.SERVER_PUBLIC_KEY_PATH
+
         # Try to load existing keys
-        if os.path.exists(private_key_path) and os.path.exists(public_key_path):
+        if os.path.exists(private_key_path):
             with open(private_key_path, 'rb') as f:
                 private_key = serialization.load_pem_private_key(
                     f.read(),
@@ -28,42 +68,33 @@ def load_server_keys():
                     backend=default_backend()
                 )
 
-            with open(public_key_path, 'rb') as f:
-                public_key = serialization.load_pem_public_key(
-                    f.read(),
-                    backend=default_backend()
-                )
-
             logger.info("Loaded existing server keys")
-        else:
-            # Generate new key pair
-            private_key = rsa.generate_private_key(
-                public_exponent=65537,
-                key_size=2048,
-                backend=default_backend()
-            )
-            public_key = private_key.public_key()
+            return private_key, private_key.public_key()
 
-            # Serialize keys to PEM format
-            private_pem = private_key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.PKCS8,
-                encryption_algorithm=serialization.NoEncryption()
-            )
+        # Generate new key pair
+        private_key = _generate_server_key()
+        public_key = private_key.public_key()
 
-            public_pem = public_key.public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            )
+        # Serialize keys to PEM format
+        private_pem = private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+
+        public_pem = public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
 
-            # Save keys to files
-            with open(private_key_path, 'wb') as f:
-                f.write(private_pem)
+        # Save keys to files
+        with open(private_key_path, 'wb') as f:
+            f.write(private_pem)
 
-            with open(public_key_path, 'wb') as f:
-                f.write(public_pem)
+        with open(public_key_path, 'wb') as f:
+            f.write(public_pem)
 
-            logger.info("Generated and saved new server keys")
+        logger.info("Generated and saved new server keys")
 
         return private_key, public_key
     except Exception as e:
@@ -71,20 +102,99 @@ def load_server_keys():
         raise
 
 
-# Global server keys
-SERVER_PRIVATE_KEY, SERVER_PUBLIC_KEY = load_server_keys()
+# Server key pair with its serialized public key and ETag, loaded on first use
+_server_keys = None
+_server_keys_lock = threading.Lock()
+
+
+def _get_server_keys():
+    global _server_keys
+    if _server_keys is None:
+        with _server_keys_lock:
+            if _server_keys is None:
+                private_key, public_key = load_server_keys()
+
+                # The public key never changes while the process runs, so serialize it once
+                public_pem = public_key.public_bytes(
+                    encoding=serialization.Encoding.PEM,
+                    format=serialization.PublicFormat.SubjectPublicKeyInfo
+                ).decode('utf-8')
+                etag = f'"{hashlib.sha256(public_pem.encode()).hexdigest()}"'
+
+                _server_keys = (private_key, public_key, public_pem, etag)
+    return _server_keys
+
+
+def reset_server_keys():
+    """Forget the loaded server keys so the next use reloads them from settings"""
+    global _server_keys
+    with _server_keys_lock:
+        _server_keys = None
+
+
+@receiver(setting_changed)
+def _reload_server_keys(setting, **kwargs):
+    if setting in ('SERVER_PRIVATE_KEY_PEM', 'SERVER_KEY_IN_MEMORY',
+                   'SERVER_PRIVATE_KEY_PATH', 'SERVER_PUBLIC_KEY_PATH'):
+        reset_server_keys()
+
+
+def get_server_private_key():
+    return _get_server_keys()[0]
+
+
+def get_server_public_key():
+    return _get_server_keys()[1]
+
+
+# Parsed device public keys, keyed by the SHA-256 of their PEM
+PUBLIC_KEY_CACHE_SIZE = 1024
+_public_key_cache = OrderedDict()
+_public_key_cache_lock = threading.Lock()
 
 
 def get_server_public_key_pem():
     """Get server public key in PEM format"""
-    return SERVER_PUBLIC_KEY.public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo
-    ).decode('utf-8')
+    return _get_server_keys()[2]
+
+
+def get_server_public_key_etag():
+    """Get the HTTP entity tag identifying the current server public key"""
+    return _get_server_keys()[3]
+
+
+def load_device_public_key(public_key_pem):
+    """Parse a device's PEM public key, reusing the parsed object for keys seen recently"""
+    digest = hashlib.sha256(public_key_pem.encode()).digest()
+    with _public_key_cache_lock:
+        public_key = _public_key_cache.get(digest)
+        if public_key is not None:
+            _public_key_cache.move_to_end(digest)
+            return public_key
+
+    public_key = serialization.load_pem_public_key(
+        public_key_pem.encode(),
+        backend=default_backend()
+    )
+
+    with _public_key_cache_lock:
+        _public_key_cache[digest] = public_key
+        while len(_public_key_cache) > PUBLIC_KEY_CACHE_SIZE:
+            _public_key_cache.popitem(last=False)
+
+    return public_key
 
 
 def decrypt_with_private_key(encrypted_data):
     """Decrypt data using the server's private key and AES"""
+    pool = get_private_key_pool()
+    if pool is not None:
+        return pool.decrypt(encrypted_data)
+    return _decrypt_envelope(encrypted_data, get_server_private_key())
+
+
+def _decrypt_envelope(encrypted_data, private_key):
+    """Open a device's RSA-wrapped AES-CBC envelope with the given private key"""
     try:
         # Verify we have a dictionary with the expected components
         if not isinstance(encrypted_data,
@@ -99,7 +209,7 @@ def decrypt_with_private_key(encrypted_data):
         ciphertext = base64.b64decode(encrypted_data['ciphertext'])
 
         # Decrypt the AES key with RSA
-        aes_key = SERVER_PRIVATE_KEY.decrypt(
+        aes_key = private_key.decrypt(
             encrypted_key,
             padding.OAEP(
                 mgf=padding.MGF1(algorithm=hashes.SHA256()),
@@ -124,24 +234,101 @@ def decrypt_with_private_key(encrypted_data):
         raise
 
 
-def encrypt_with_public_key(data, public_key_pem):
-    """Encrypt data using a device's public key"""
+# Server private key as loaded by each private-key pool worker
+_worker_private_key = None
+
+
+def _init_private_key_worker(private_pem):
+    """Pool initializer: parse the server private key once per worker process"""
+    global _worker_private_key
+    _worker_private_key = serialization.load_pem_private_key(private_pem, password=None, backend=default_backend())
+
+
+def _decrypt_in_worker(encrypted_data):
+    return _decrypt_envelope(encrypted_data, _worker_private_key)
+
+
+class PrivateKeyPool:
+    """
+    Process pool for the server's private-key (RSA) operations.
+
+    RSA decryption is CPU-bound and holds the GIL, so concurrent registrations
+    in one server process serialize on it. Handing it to worker processes lets
+    a burst of registrations use every core. Workers are spawned rather than
+    forked so they don't inherit the server's threads or database connections.
+    """
+
+    def __init__(self, workers, private_key=None):
+        private_key = private_key or get_server_private_key()
+        private_pem = private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_private_key_worker,
+            initargs=(private_pem,)
+        )
+
+    def decrypt(self, encrypted_data):
+        """decrypt_with_private_key() run in a worker process"""
+        return self._executor.submit(_decrypt_in_worker, encrypted_data).result()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+_private_key_pool = None
+_private_key_pool_lock = threading.Lock()
+
+
+def get_private_key_pool():
+    """The process-wide private-key pool, or None when CRYPTO_POOL_WORKERS is 0"""
+    global _private_key_pool
+    if _private_key_pool is None:
+        if not settings.CRYPTO_POOL_WORKERS:
+            return None
+        with _private_key_pool_lock:
+            if _private_key_pool is None:
+                _private_key_pool = PrivateKeyPool(settings.CRYPTO_POOL_WORKERS)
+                atexit.register(_private_key_pool.shutdown)
+    return _private_key_pool
+
+
+def encrypt_with_public_key(data, public_key_pem, hybrid=False):
+    """
+    Encrypt data using a device's public key.
+
+    By default the JSON is RSA-OAEP encrypted directly, which limits it to
+    about 190 bytes for a 2048-bit key. With hybrid=True it is sealed with a
+    fresh AES-GCM key that is itself RSA-wrapped, mirroring the envelope
+    devices send to decrypt_with_private_key, so any payload size fits.
+    """
     try:
-        device_public_key = serialization.load_pem_public_key(
-            public_key_pem.encode(),
-            backend=default_backend()
+        device_public_key = load_device_public_key(public_key_pem)
+        oaep = padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
         )
 
         json_data = json.dumps(data).encode()
 
-        encrypted = device_public_key.encrypt(
-            json_data,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
+        if hybrid:
+            aes_key = AESGCM.generate_key(bit_length=256)
+            nonce = os.urandom(12)
+            ciphertext = AESGCM(aes_key).encrypt(nonce, json_data, None)
+
+            return {
+                'encrypted_key': base64.b64encode(device_public_key.encrypt(aes_key, oaep)).decode(),
+                'nonce': base64.b64encode(nonce).decode(),
+                'ciphertext': base64.b64encode(ciphertext).decode()
+            }
+
+        encrypted = device_public_key.encrypt(json_data, oaep)
 
         return base64.b64encode(encrypted).decode()
     except Exception as e:
@@ -149,26 +336,29 @@ def encrypt_with_public_key(data, public_key_pem):
         raise
 
 
-def decrypt_with_session_key(encrypted_data, session_key):
-    """Decrypt data using an AES session key"""
-    try:
-        # Convert session key to bytes and ensure it's 32 bytes (256 bits)
-        if isinstance(session_key, str):
-            key = session_key.encode('utf-8')
-        else:
-            key = session_key
+def derive_session_key(session_key):
+    """Turn a session key string into the 32-byte (256-bit) AES key used on the wire"""
+    if isinstance(session_key, str):
+        key = session_key.encode('utf-8')
+    else:
+        key = session_key
 
-        if len(key) > 32:
-            key = key[:32]
-        elif len(key) < 32:
-            key = key + b'\0' * (32 - len(key))
+    if len(key) > 32:
+        key = key[:32]
+    elif len(key) < 32:
+        key = key + b'\0' * (32 - len(key))
+
+    return key
 
-        # Decode from base64
-        decoded_data = base64.b64decode(encrypted_data)
+
+def open_with_session_key(frame, session_key):
+    """Decrypt a raw IV | ciphertext frame using an AES session key"""
+    try:
+        key = derive_session_key(session_key)
 
         # Extract IV and ciphertext
-        iv = decoded_data[:16]
-        ciphertext = decoded_data[16:]
+        iv = frame[:16]
+        ciphertext = frame[16:]
 
         # Decrypt with AES-CBC
         cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
@@ -186,15 +376,27 @@ def decrypt_with_session_key(encrypted_data, session_key):
         raise
 
 
-def encrypt_with_session_key(data, session_key):
-    """Encrypt data using an AES session key"""
+def decrypt_with_session_key(encrypted_data, session_key):
+    """Decrypt data using an AES session key (string, or bytes from derive_session_key)"""
+    try:
+        # Decode from base64
+        decoded_data = base64.b64decode(encrypted_data)
+    except Exception as e:
+        logger.error(f"Error decrypting with session key: {str(e)}")
+        raise
+
+    return open_with_session_key(decoded_data, session_key)
+
+
+def seal_with_session_key(data, session_key):
+    """Encrypt data using an AES session key into a raw IV | ciphertext frame"""
     try:
         # Convert data to JSON and then encode to bytes
         json_data = json.dumps(data).encode()
 
         # Derive a 32-byte (256-bit) key from the session key
         # This ensures the key is exactly the right size for AES-256
-        key = session_key.encode()[:32]
+        key = derive_session_key(session_key)
 
         # Generate a random IV
         iv = os.urandom(16)  # 16 bytes for CBC mode
@@ -213,10 +415,99 @@ def encrypt_with_session_key(data, session_key):
         # Encrypt the data
         ciphertext = encryptor.update(padded_data) + encryptor.finalize()
 
-        # Combine IV and ciphertext and encode to base64
-        encrypted = base64.b64encode(iv + ciphertext).decode()
-
-        return encrypted
+        return iv + ciphertext
     except Exception as e:
         logger.error(f"Error encrypting with session key: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+
+
+def encrypt_with_session_key(data, session_key):
+    """Encrypt data using an AES session key (string, or bytes from derive_session_key)"""
+    return base64.b64encode(seal_with_session_key(data, session_key)).decode()
+
+
+# Session channels negotiated at registration. 'cbc' is the original
+# unauthenticated AES-CBC format; 'gcm' is AES-GCM with a per-session key.
+SESSION_CHANNEL_CBC = 'cbc'
+SESSION_CHANNEL_GCM = 'gcm'
+SESSION_CHANNELS = (SESSION_CHANNEL_CBC, SESSION_CHANNEL_GCM)
+
+# First byte of every 'gcm' channel message, so the format can evolve
+GCM_CHANNEL_VERSION = 2
+
+
+def derive_gcm_session_key(session_key):
+    """Derive the AES-256-GCM key of a 'gcm' channel from the session key with HKDF-SHA256"""
+    if isinstance(session_key, str):
+        session_key = session_key.encode('utf-8')
+
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'session-channel:gcm'
+    ).derive(session_key)
+
+
+class CbcSessionCipher:
+    """The original AES-CBC session format, with the key derived once"""
+
+    channel = SESSION_CHANNEL_CBC
+
+    def __init__(self, session_key):
+        self._key = derive_session_key(session_key)
+
+    def seal(self, data):
+        return seal_with_session_key(data, self._key)
+
+    def open(self, frame):
+        return open_with_session_key(frame, self._key)
+
+    def encrypt(self, data):
+        return encrypt_with_session_key(data, self._key)
+
+    def decrypt(self, encrypted_data):
+        return decrypt_with_session_key(encrypted_data, self._key)
+
+
+class GcmSessionCipher:
+    """
+    AES-GCM session format: version | 12-byte nonce | ciphertext + tag,
+    base64-encoded when carried inside JSON.
+
+    One AEAD call per message encrypts and authenticates it, with no padding
+    pass. The AESGCM context is built once per session and reused.
+    """
+
+    channel = SESSION_CHANNEL_GCM
+
+    def __init__(self, session_key):
+        self._aead = AESGCM(derive_gcm_session_key(session_key))
+
+    def seal(self, data):
+        nonce = os.urandom(12)
+        ciphertext = self._aead.encrypt(nonce, json.dumps(data).encode(), None)
+        return bytes([GCM_CHANNEL_VERSION]) + nonce + ciphertext
+
+    def open(self, frame):
+        try:
+            if frame[0] != GCM_CHANNEL_VERSION:
+                raise ValueError(f"Unsupported session channel version: {frame[0]}")
+
+            return json.loads(self._aead.decrypt(frame[1:13], frame[13:], None).decode())
+        except Exception as e:
+            logger.error(f"Error decrypting with session key: {str(e)}")
+            raise
+
+    def encrypt(self, data):
+        return base64.b64encode(self.seal(data)).decode()
+
+    def decrypt(self, encrypted_data):
+        return self.open(base64.b64decode(encrypted_data))
+
+
+def get_session_cipher(session_key, channel=SESSION_CHANNEL_CBC):
+    """Build the cipher for a device's negotiated session channel"""
+    if channel == SESSION_CHANNEL_GCM:
+        return GcmSessionCipher(session_key)
+    return CbcSessionCipher(session_key)
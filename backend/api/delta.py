@@ -0,0 +1,110 @@
+import base64
+import hashlib
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import Tombstone
+from .pagination import InvalidCursor
+
+
+class SinceExpired(Exception):
+    """Raised when a ?since= delta cannot be served and the client has to reload the full listing"""
+
+
+def encode_since(timestamp):
+    """Build an opaque ?since= token for the given point in time"""
+    return base64.urlsafe_b64encode(f"since|{timestamp.isoformat()}".encode()).decode()
+
+
+def decode_since(token):
+    try:
+        prefix, timestamp = base64.urlsafe_b64decode(token.encode()).decode().split('|', 1)
+        if prefix != 'since':
+            raise ValueError(prefix)
+        since = datetime.fromisoformat(timestamp)
+        # Tokens are handed out timezone-aware; a naive one cannot be compared
+        if timezone.is_naive(since):
+            raise ValueError(timestamp)
+        return since
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid since token: {token}") from e
+
+
+def next_since():
+    """
+    The ?since= token to hand out with a listing, taken before it is read.
+
+    It lags behind now by SYNC_CURSOR_LAG seconds: a transaction can commit
+    after rows with later timestamps were already read, and the lag makes the
+    next delta pick such rows up (at the cost of repeating a few).
+    """
+    return encode_since(timezone.now() - timedelta(seconds=settings.SYNC_CURSOR_LAG))
+
+
+def parse_since(request):
+    """The ?since= timestamp, or None when a full listing was asked for"""
+    token = request.query_params.get('since')
+    if not token:
+        return None
+
+    since = decode_since(token)
+    if since < timezone.now() - timedelta(seconds=settings.SYNC_TOMBSTONE_RETENTION):
+        # Tombstones this old may have been pruned, so deletions could be missed
+        raise SinceExpired('The since token has expired')
+    return since
+
+
+def changed_since(queryset, changed, limit=None):
+    """Evaluate a delta query, refusing deltas larger than a full page"""
+    limit = limit or settings.API_MAX_PAGE_SIZE
+    items = list(queryset.filter(changed)[:limit + 1])
+    if len(items) > limit:
+        raise SinceExpired('Too many changes since the given token')
+    return items
+
+
+def removed_since(queryset, listed, changed, field='pk', limit=None):
+    """
+    Values of `field` for the rows changed since the token that no longer
+    match the listing's filters: `queryset` is the unfiltered listing and
+    `listed` the filtered one. A filtered delta reports them next to
+    the deleted ids so clients drop them too.
+    """
+    limit = limit or settings.API_MAX_PAGE_SIZE
+    removed = [
+        str(value) for value in
+        queryset.filter(changed).exclude(pk__in=listed.values('pk')).values_list(field, flat=True)[:limit + 1]
+    ]
+    if len(removed) > limit:
+        raise SinceExpired('Too many changes since the given token')
+    return removed
+
+
+def deleted_since(kind, since):
+    """Ids of the devices or commands deleted after `since`"""
+    return list(
+        Tombstone.objects.filter(kind=kind, deleted_at__gt=since).values_list('object_id', flat=True)
+    )
+
+
+def listing_etag(request, kind, fingerprint):
+    """
+    ETag of a listing response, from the fingerprint of what it would contain.
+
+    The fingerprint (latest change timestamps and count of the filtered rows,
+    the count catching rows that left the filter) plus the
+    latest deletion and the query string identify the response without
+    building it, so an unchanged listing is answered with 304.
+    """
+    latest_deletion = Tombstone.objects.filter(kind=kind).aggregate(latest=Max('deleted_at'))['latest']
+    raw = f"{request.get_full_path()}|{fingerprint}|{latest_deletion}"
+    return f'"{hashlib.sha256(raw.encode()).hexdigest()}"'
+
+
+def prune_tombstones():
+    """Delete tombstones older than SYNC_TOMBSTONE_RETENTION, returning how many were removed"""
+    threshold = timezone.now() - timedelta(seconds=settings.SYNC_TOMBSTONE_RETENTION)
+    deleted, _ = Tombstone.objects.filter(deleted_at__lt=threshold).delete()
+    return deleted
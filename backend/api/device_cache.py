@@ -0,0 +1,245 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .crypto import get_session_cipher
+from .models import Device
+
+logger = logging.getLogger(__name__)
+
+# What device-originated requests need to authenticate a device
+DeviceCredentials = namedtuple(
+    'DeviceCredentials', ['pk', 'device_id', 'session_key', 'is_active', 'session_channel', 'cipher']
+)
+
+
+class DeviceCache:
+    """
+    Process-local LRU cache of device_id -> DeviceCredentials with a TTL.
+
+    When DEVICE_CACHE_ALIAS names a Django cache, entries are also shared
+    through it so other server processes can skip the database too. The
+    shared entry is then authoritative: a local entry is only used while it
+    matches it, so invalidate() in one process (which deletes the shared
+    entry) takes effect in all of them. Without a shared cache, other
+    processes may use a stale entry for up to DEVICE_CACHE_TTL; decrypt()
+    covers the session-key case by re-reading the device once on failure.
+    Views that change a device's session key or active flag must call
+    invalidate().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, device_id):
+        """Return the device's credentials, or None if it does not exist"""
+        now = time.monotonic()
+        shared = self._shared_cache()
+        if shared is None:
+            credentials = self._lookup(device_id, now)
+            if credentials is not None:
+                return credentials
+            row = self._rows(device_id).first()
+        else:
+            # The shared tier holds plain rows; cipher objects are built per process
+            row = shared.get(self._shared_key(device_id))
+            if row is not None:
+                credentials = self._lookup(device_id, now)
+                if credentials is not None and self._row(credentials) == row:
+                    return credentials
+            else:
+                row = self._rows(device_id).first()
+                if row is not None:
+                    shared.set(self._shared_key(device_id), row, settings.DEVICE_CACHE_TTL)
+
+        if row is None:
+            return None
+        return self._store(device_id, self._credentials(device_id, row), now)
+
+    async def aget(self, device_id):
+        """Async get() for the ASGI views, using the async ORM and cache APIs"""
+        now = time.monotonic()
+        shared = self._shared_cache()
+        if shared is None:
+            credentials = self._lookup(device_id, now)
+            if credentials is not None:
+                return credentials
+            row = await self._rows(device_id).afirst()
+        else:
+            row = await shared.aget(self._shared_key(device_id))
+            if row is not None:
+                credentials = self._lookup(device_id, now)
+                if credentials is not None and self._row(credentials) == row:
+                    return credentials
+            else:
+                row = await self._rows(device_id).afirst()
+                if row is not None:
+                    await shared.aset(self._shared_key(device_id), row, settings.DEVICE_CACHE_TTL)
+
+        if row is None:
+            return None
+        return self._store(device_id, self._credentials(device_id, row), now)
+
+    def reload(self, device_id):
+        """Re-read a device from the database, replacing its cached entries"""
+        with self._lock:
+            self._entries.pop(device_id, None)
+
+        shared = self._shared_cache()
+        row = self._rows(device_id).first()
+        if shared is not None:
+            if row is None:
+                shared.delete(self._shared_key(device_id))
+            else:
+                shared.set(self._shared_key(device_id), row, settings.DEVICE_CACHE_TTL)
+        if row is None:
+            return None
+        return self._store(device_id, self._credentials(device_id, row), time.monotonic())
+
+    async def areload(self, device_id):
+        with self._lock:
+            self._entries.pop(device_id, None)
+
+        shared = self._shared_cache()
+        row = await self._rows(device_id).afirst()
+        if shared is not None:
+            if row is None:
+                await shared.adelete(self._shared_key(device_id))
+            else:
+                await shared.aset(self._shared_key(device_id), row, settings.DEVICE_CACHE_TTL)
+        if row is None:
+            return None
+        return self._store(device_id, self._credentials(device_id, row), time.monotonic())
+
+    def decrypt(self, credentials, frame=None, encrypted_data=None):
+        """
+        Decrypt a device payload, either a binary frame or base64 data.
+
+        A failure may only mean the cached session key is stale (the device
+        reconnected through another server process), so the device is
+        re-read and the payload retried once before the error is raised.
+        Returns (credentials, data) with the credentials that worked.
+        """
+        try:
+            return credentials, self._decrypt(credentials.cipher, frame, encrypted_data)
+        except Exception:
+            fresh = self.reload(credentials.device_id)
+            if fresh is None or self._row(fresh) == self._row(credentials):
+                raise
+        return fresh, self._decrypt(fresh.cipher, frame, encrypted_data)
+
+    async def adecrypt(self, credentials, frame=None, encrypted_data=None):
+        """decrypt() for the async views, running the crypto in a worker thread"""
+        decrypt = sync_to_async(self._decrypt, thread_sensitive=False)
+        try:
+            return credentials, await decrypt(credentials.cipher, frame, encrypted_data)
+        except Exception:
+            fresh = await self.areload(credentials.device_id)
+            if fresh is None or self._row(fresh) == self._row(credentials):
+                raise
+        return fresh, await decrypt(fresh.cipher, frame, encrypted_data)
+
+    def get_active(self, device_id):
+        """Like get(), but returns None for deregistered or inactive devices"""
+        credentials = self.get(device_id)
+        if credentials is None or not credentials.is_active:
+            return None
+        return credentials
+
+    async def aget_active(self, device_id):
+        credentials = await self.aget(device_id)
+        if credentials is None or not credentials.is_active:
+            return None
+        return credentials
+
+    async def ainvalidate(self, device_id):
+        with self._lock:
+            self._entries.pop(device_id, None)
+
+        shared = self._shared_cache()
+        if shared is not None:
+            await shared.adelete(self._shared_key(device_id))
+
+    def invalidate(self, device_id):
+        """Forget a device after its session key or active flag changed"""
+        with self._lock:
+            self._entries.pop(device_id, None)
+
+        shared = self._shared_cache()
+        if shared is not None:
+            shared.delete(self._shared_key(device_id))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _lookup(self, device_id, now):
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is not None:
+                credentials, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(device_id)
+                    return credentials
+                del self._entries[device_id]
+        return None
+
+    @staticmethod
+    def _rows(device_id):
+        return Device.objects.filter(device_id=device_id).values(
+            'pk', 'session_key', 'is_active', 'session_channel'
+        )
+
+    @staticmethod
+    def _row(credentials):
+        """The shared-tier row the credentials were built from"""
+        return {
+            'pk': credentials.pk,
+            'session_key': credentials.session_key,
+            'is_active': credentials.is_active,
+            'session_channel': credentials.session_channel
+        }
+
+    @staticmethod
+    def _decrypt(cipher, frame, encrypted_data):
+        return cipher.open(frame) if frame else cipher.decrypt(encrypted_data)
+
+    @staticmethod
+    def _credentials(device_id, row):
+        return DeviceCredentials(
+            pk=row['pk'],
+            device_id=device_id,
+            session_key=row['session_key'],
+            is_active=row['is_active'],
+            session_channel=row['session_channel'],
+            cipher=get_session_cipher(row['session_key'], row['session_channel'])
+        )
+
+    def _store(self, device_id, credentials, now):
+        if settings.DEVICE_CACHE_TTL <= 0:
+            return credentials
+
+        with self._lock:
+            self._entries[device_id] = (credentials, now + settings.DEVICE_CACHE_TTL)
+            self._entries.move_to_end(device_id)
+            while len(self._entries) > settings.DEVICE_CACHE_SIZE:
+                self._entries.popitem(last=False)
+        return credentials
+
+    def _shared_cache(self):
+        if not settings.DEVICE_CACHE_ALIAS:
+            return None
+        return caches[settings.DEVICE_CACHE_ALIAS]
+
+    @staticmethod
+    def _shared_key(device_id):
+        return f'device-credentials:{device_id}'
+
+
+# Process-wide cache shared by the device-facing views
+device_cache = DeviceCache()
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class _AsyncListener:
+    """
+    An asyncio.Event that can be set from any thread, registered with the
+    notifier while used as an async context manager.
+
+    A class rather than an @asynccontextmanager: a generator there would be
+    finalized separately from the (often never closed) streaming generator
+    using it, and the registration could leak instead of being removed.
+    """
+
+    def __init__(self, notifier, device_key):
+        self._notifier = notifier
+        self._device_key = device_key
+        self._loop = None
+        self.event = asyncio.Event()
+
+    async def __aenter__(self):
+        self._loop = asyncio.get_running_loop()
+        self._notifier._add(self._device_key, self)
+        return self.event
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        self._notifier._remove(self._device_key, self)
+
+    def set(self):
+        try:
+            self._loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            # The listener's event loop is gone without it having left; drop it
+            # rather than fail the caller, e.g. a committed command creation
+            logger.debug(f"Dropping listener of device {self._device_key} whose event loop is closed")
+            self._notifier._remove(self._device_key, self)
+
+
+class CommandNotifier:
+    """
+    Wakes up long-polling requests when a new command is queued for a device.
+
+    Sync views wait on a threading.Event from listen(); async views wait on an
+    asyncio.Event from alisten(). notify() may be called from either side.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = {}
+
+    @contextmanager
+    def listen(self, device_key):
+        """Register interest in a device before querying, so no notification is missed"""
+        event = threading.Event()
+        self._add(device_key, event)
+        try:
+            yield event
+        finally:
+            self._remove(device_key, event)
+
+    def alisten(self, device_key):
+        """listen() for async views: `async with` it to get an asyncio.Event"""
+        return _AsyncListener(self, device_key)
+
+    def _add(self, device_key, listener):
+        with self._lock:
+            self._listeners.setdefault(device_key, set()).add(listener)
+
+    def _remove(self, device_key, listener):
+        with self._lock:
+            listeners = self._listeners.get(device_key)
+            if listeners is not None:
+                listeners.discard(listener)
+                if not listeners:
+                    del self._listeners[device_key]
+
+    def notify(self, device_key):
+        """Wake up every request waiting on the given device"""
+        with self._lock:
+            listeners = list(self._listeners.get(device_key, ()))
+        for event in listeners:
+            event.set()
+        if listeners:
+            logger.debug(f"Woke {len(listeners)} long poll(s) for device {device_key}")
+
+
+# Process-wide notifier shared by the views
+command_notifier = CommandNotifier()
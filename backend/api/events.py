@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import threading
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class _Subscriber:
+    """One open dashboard stream: an asyncio queue fed from any thread"""
+
+    def __init__(self, max_queued):
+        self._loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.overflowed = False
+
+    def deliver(self, event):
+        self._loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # The client fell too far behind; it will be told to reload instead
+            self.overflowed = True
+
+
+class EventBroadcaster:
+    """
+    Fans out device and command change events to the open dashboard streams.
+
+    Events get increasing ids and the most recent ones are kept, so a
+    reconnecting EventSource can resume from its Last-Event-ID. Events only
+    reach streams served by the same process; clients reload their lists
+    when told to resync and periodically as a safety net.
+    """
+
+    def __init__(self, backlog=1000, max_queued=1000):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._recent = deque(maxlen=backlog)
+        self._max_queued = max_queued
+        self._next_id = 1
+        # Ids from a previous server run must not match this run's
+        self._run_id = uuid.uuid4().hex[:8]
+
+    def publish(self, event_type, data):
+        """Send an event to every subscriber; safe to call from any thread"""
+        with self._lock:
+            event = (f'{self._run_id}-{self._next_id}', event_type, data)
+            self._next_id += 1
+            self._recent.append(event)
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.deliver(event)
+
+    @asynccontextmanager
+    async def subscribe(self, last_event_id=None):
+        """
+        Yield (queue, missed, subscriber) for a new stream.
+
+        `missed` holds the events after last_event_id, or is None when they
+        are no longer available and the client has to reload.
+        """
+        subscriber = _Subscriber(self._max_queued)
+        with self._lock:
+            self._subscribers.add(subscriber)
+            missed = self._events_after(last_event_id) if last_event_id else []
+        try:
+            yield subscriber.queue, missed, subscriber
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+    def _events_after(self, last_event_id):
+        ids = [event[0] for event in self._recent]
+        if last_event_id not in ids:
+            return None
+        return list(self._recent)[ids.index(last_event_id) + 1:]
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+def publish_device_status(device_id, is_active, last_seen=None):
+    event_broadcaster.publish('device', {
+        'deviceId': device_id,
+        'isActive': is_active,
+        'lastSeen': _isoformat(last_seen)
+    })
+
+
+def publish_command(command, device_id, device_type):
+    """A newly queued command, in the shape of the command history listing"""
+    event_broadcaster.publish('command', {
+        'id': str(command.id),
+        'deviceId': device_id,
+        'deviceType': device_type,
+        'name': command.name,
+        'params': command.params,
+        'status': command.status,
+        'result': command.result,
+        'priority': command.priority,
+        'deadline': _isoformat(command.deadline),
+        'createdAt': _isoformat(command.created_at),
+        'updatedAt': _isoformat(command.updated_at)
+    })
+
+
+def publish_commands(commands, max_events=100):
+    """
+    Newly queued batch commands (with their device loaded).
+
+    A large batch is announced with a single resync instead, which makes the
+    dashboards reload their lists rather than overflow their queues.
+    """
+    if len(commands) > max_events:
+        event_broadcaster.publish('resync', {})
+        return
+    for command in commands:
+        publish_command(command, command.device.device_id, command.device.device_type)
+
+
+def publish_command_status(command_id, status, updated_at, result=None):
+    data = {'id': str(command_id), 'status': status, 'updatedAt': _isoformat(updated_at)}
+    if result is not None:
+        data['result'] = result
+    event_broadcaster.publish('command', data)
+
+
+# Process-wide broadcaster shared by the views
+event_broadcaster = EventBroadcaster()
@@ -0,0 +1,44 @@
+from django.http import HttpResponse
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+# Wire framings a device can negotiate. 'json' wraps base64 ciphertext in a
+# JSON body; 'binary' sends the raw session frame as the request/response body.
+FRAMING_JSON = 'json'
+FRAMING_BINARY = 'binary'
+
+BINARY_CONTENT_TYPE = 'application/octet-stream'
+
+# Identifies the device on binary requests whose URL does not carry it
+DEVICE_ID_HEADER = 'X-Device-Id'
+
+
+class BinaryFrameRenderer(BaseRenderer):
+    """
+    Lets DRF accept `Accept: application/octet-stream` on device endpoints.
+
+    Frames are returned as plain HttpResponses, so this only renders the
+    error payloads of those views, which stay JSON.
+    """
+
+    media_type = BINARY_CONTENT_TYPE
+    format = 'bin'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, bytes):
+            return data
+        return JSONRenderer().render(data)
+
+
+def is_binary_request(request):
+    """Whether the request body is a raw session frame"""
+    return request.content_type.split(';')[0].strip() == BINARY_CONTENT_TYPE
+
+
+def wants_binary_response(request):
+    """Whether the device asked for a raw session frame back"""
+    return BINARY_CONTENT_TYPE in request.headers.get('Accept', '')
+
+
+def binary_response(frame, headers=None):
+    return HttpResponse(frame, content_type=BINARY_CONTENT_TYPE, headers=headers)
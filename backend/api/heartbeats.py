@@ -0,0 +1,83 @@
+import atexit
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import Device
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatBuffer:
+    """
+    Collects device last-seen timestamps in memory and writes them in bulk.
+
+    Heartbeats and polls only need to move last_seen forward, so instead of a
+    full-row save per request the latest timestamp per device is kept here and
+    flushed every HEARTBEAT_FLUSH_INTERVAL seconds with one bulk UPDATE per batch.
+    An interval of 0 disables buffering and writes each timestamp immediately.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flusher = None
+
+    def record(self, device_pk):
+        """Note that the device was seen just now"""
+        now = timezone.now()
+        if settings.HEARTBEAT_FLUSH_INTERVAL <= 0:
+            Device.objects.filter(pk=device_pk).update(last_seen=now)
+            return
+
+        with self._lock:
+            self._pending[device_pk] = now
+            if self._flusher is None:
+                self._start_flusher()
+
+    async def arecord(self, device_pk):
+        """record() for the async views"""
+        if settings.HEARTBEAT_FLUSH_INTERVAL <= 0:
+            await Device.objects.filter(pk=device_pk).aupdate(last_seen=timezone.now())
+            return
+        self.record(device_pk)
+
+    def flush(self):
+        """Write all buffered timestamps to the database, returning how many devices were updated"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        devices = [Device(pk=pk, last_seen=last_seen) for pk, last_seen in pending.items()]
+        try:
+            Device.objects.bulk_update(devices, ['last_seen'], batch_size=settings.HEARTBEAT_FLUSH_BATCH_SIZE)
+        except Exception:
+            # Put the timestamps back unless a newer heartbeat arrived meanwhile
+            with self._lock:
+                for pk, last_seen in pending.items():
+                    self._pending.setdefault(pk, last_seen)
+            raise
+        logger.debug(f"Flushed heartbeats of {len(devices)} devices")
+        return len(devices)
+
+    def _start_flusher(self):
+        self._flusher = threading.Thread(target=self._run, name='heartbeat-flusher', daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(settings.HEARTBEAT_FLUSH_INTERVAL)
+            try:
+                close_old_connections()
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing heartbeats: {str(e)}")
+
+
+# Process-wide buffer shared by the device-facing views
+heartbeat_buffer = HeartbeatBuffer()
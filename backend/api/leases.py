@@ -0,0 +1,124 @@
+import logging
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Command, Job, _transitions
+from .scheduler import least_loaded_device
+
+logger = logging.getLogger(__name__)
+
+
+def expired_leases(now):
+    """Sent commands whose device did not report back before the lease ran out"""
+    # Commands sent before leases existed have none; their last update stands in
+    legacy_threshold = now - timedelta(seconds=settings.COMMAND_LEASE_DURATION)
+    return Command.objects.filter(
+        Q(leased_until__lt=now) | Q(leased_until=None, updated_at__lt=legacy_threshold),
+        status='sent'
+    )
+
+
+def reap_expired_leases(max_attempts=None, reassign=True, batch_size=500):
+    """
+    Hand out again the commands whose lease expired.
+
+    A command that already used max_attempts deliveries (COMMAND_MAX_ATTEMPTS
+    by default) or is past its deadline is failed. Otherwise it goes back
+    to 'pending', on the least-loaded other online device supporting it
+    when `reassign` is set and there is one, else on its own device.
+    Returns the number of commands (requeued, reassigned, failed).
+    """
+    max_attempts = max_attempts or settings.COMMAND_MAX_ATTEMPTS
+    now = timezone.now()
+    outcomes = Counter()
+
+    while True:
+        expired = list(
+            expired_leases(now).values(
+                'id', 'device_id', 'name', 'attempts', 'deadline', 'job_id', 'leased_until'
+            )[:batch_size]
+        )
+        for command in expired:
+            outcomes[_reap(command, max_attempts, reassign, now)] += 1
+        if len(expired) < batch_size:
+            break
+
+    requeued, reassigned, failed = outcomes['requeued'], outcomes['reassigned'], outcomes['failed']
+    if requeued or reassigned or failed:
+        logger.info(f"Reaped expired leases: {requeued} requeued, {reassigned} reassigned, {failed} failed")
+    return requeued, reassigned, failed
+
+
+def _reap(command, max_attempts, reassign, now):
+    """
+    Fail or requeue one expired command, returning what was done.
+
+    The update is conditional on the command still being sent under the
+    same lease, so a result arriving meanwhile wins and None is returned.
+    """
+    still_expired = Command.objects.filter(id=command['id'], status='sent', leased_until=command['leased_until'])
+
+    overdue = command['deadline'] is not None and command['deadline'] <= now
+    if overdue or command['attempts'] >= max_attempts:
+        error = 'Deadline passed' if overdue else f"Lease expired after {command['attempts']} attempts"
+        changed = still_expired.update(
+            status='failed',
+            result={'status': 'failed', 'error': error},
+            leased_until=None,
+            updated_at=now
+        )
+        outcome, new_status = 'failed', 'failed'
+    else:
+        device = least_loaded_device(command['name'], exclude=command['device_id']) if reassign else None
+        changed = still_expired.update(
+            status='pending',
+            device_id=device.pk if device else command['device_id'],
+            leased_until=None,
+            updated_at=now
+        )
+        outcome, new_status = ('reassigned' if device else 'requeued'), 'pending'
+
+    if not changed:
+        return None
+    Job.objects.record_transitions(_transitions([('sent', command['job_id'])], new_status))
+    return outcome
+
+
+def expire_overdue_commands(batch_size=500):
+    """
+    Fail the pending commands whose deadline passed before a device claimed
+    them (claim_pending already skips them). Returns how many were failed.
+    """
+    now = timezone.now()
+    expired = 0
+
+    while True:
+        overdue = list(
+            Command.objects.filter(status='pending', deadline__lte=now).values_list('id', 'job_id')[:batch_size]
+        )
+        if not overdue:
+            break
+
+        changed = Command.objects.filter(id__in=[command_id for command_id, _ in overdue], status='pending').update(
+            status='failed',
+            result={'status': 'failed', 'error': 'Deadline passed before delivery'},
+            updated_at=now
+        )
+        expired += changed
+
+        job_ids = {job_id for _, job_id in overdue} - {None}
+        if changed == len(overdue):
+            Job.objects.record_transitions(_transitions((('pending', job_id) for _, job_id in overdue), 'failed'))
+        elif job_ids:
+            # Some changed status meanwhile; count again
+            Job.objects.filter(pk__in=job_ids).recount()
+
+        if len(overdue) < batch_size:
+            break
+
+    if expired:
+        logger.info(f"Failed {expired} pending commands past their deadline")
+    return expired
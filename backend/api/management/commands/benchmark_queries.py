@@ -0,0 +1,123 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from ...models import Device, Command as CommandModel
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway test database and report query plans and latency '
+            'of the command/device hot queries, with and without their indexes')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--devices',
+            type=int,
+            default=10000,
+            help='Number of devices to seed (default: 10000)'
+        )
+        parser.add_argument(
+            '--commands',
+            type=int,
+            default=1000000,
+            help='Number of commands to seed (default: 1000000)'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=50,
+            help='How many times each query is timed (default: 50)'
+        )
+
+    def handle(self, *args, **options):
+        # Never touch the real database: seed a test database and drop it afterwards
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self._seed(options['devices'], options['commands'])
+
+            self.stdout.write(self.style.MIGRATE_HEADING('With indexes'))
+            self._run_queries(options['repeat'])
+
+            with connection.schema_editor() as schema_editor:
+                for model in (Device, CommandModel):
+                    for index in model._meta.indexes:
+                        schema_editor.remove_index(model, index)
+
+            self.stdout.write(self.style.MIGRATE_HEADING('Without indexes'))
+            self._run_queries(options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _seed(self, device_count, command_count):
+        self.stdout.write(f'Seeding {device_count} devices and {command_count} commands...')
+        started = time.perf_counter()
+
+        devices = Device.objects.bulk_create([
+            Device(
+                device_id=f'bench-{i}',
+                device_type='calculator',
+                public_key='-',
+                session_key='-',
+                capabilities=['add', 'multiply'],
+            )
+            for i in range(device_count)
+        ], batch_size=1000)
+
+        # A small share of devices went silent a while ago
+        stale = [device.pk for device in devices[::20]]
+        Device.objects.filter(pk__in=stale).update(last_seen=timezone.now() - timedelta(hours=1))
+
+        statuses = ['completed'] * 90 + ['failed'] * 5 + ['sent'] * 3 + ['pending'] * 2
+        batch_size = 5000
+        for offset in range(0, command_count, batch_size):
+            CommandModel.objects.bulk_create([
+                CommandModel(
+                    device=random.choice(devices),
+                    name='add',
+                    params={'num1': i, 'num2': i},
+                    status=random.choice(statuses),
+                )
+                for i in range(offset, min(offset + batch_size, command_count))
+            ])
+
+        # Refresh planner statistics so the plans reflect the seeded data
+        if connection.vendor in ('sqlite', 'postgresql'):
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+        self.stdout.write(f'Seeded in {time.perf_counter() - started:.1f}s')
+
+    def _run_queries(self, repeat):
+        device = Device.objects.order_by('device_id').first()
+        now = timezone.now()
+        threshold = now - timedelta(seconds=60)
+
+        queries = {
+            # Same shape as CommandQuerySet.claim_pending, so the plan shows command_claim_idx
+            'poll (device, status, -priority, created_at)': lambda: CommandModel.objects.filter(
+                Q(deadline=None) | Q(deadline__gt=now), device=device, status='pending'
+            ).order_by('-priority', 'created_at').values('id', 'name', 'params', 'job_id')[:50],
+            'device history (device, -created_at)': lambda: CommandModel.objects.filter(
+                device=device).order_by('-created_at', '-id')[:100],
+            'global history (-created_at)': lambda: CommandModel.objects.order_by('-created_at', '-id')[:200],
+            'inactive sweep (is_active, last_seen)': lambda: Device.objects.filter(
+                is_active=True, last_seen__lt=threshold),
+        }
+
+        for name, build in queries.items():
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                list(build())
+                timings.append((time.perf_counter() - started) * 1000)
+
+            self.stdout.write(self.style.SUCCESS(
+                f'{name}: median {statistics.median(timings):.2f} ms, max {max(timings):.2f} ms'
+            ))
+            for line in build().explain().splitlines():
+                self.stdout.write(f'    {line}')
@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from ...crypto import (
+    get_server_public_key, get_server_private_key, PrivateKeyPool,
+    _decrypt_envelope, encrypt_with_public_key
+)
+
+
+class Command(BaseCommand):
+    help = 'Measure registration crypto throughput inline and with private-key pools of growing size'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--registrations',
+            type=int,
+            default=400,
+            help='Registrations processed per run (default: 400)'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=16,
+            help='Simultaneous registration requests, as request threads of one server process (default: 16)'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            nargs='+',
+            help='Pool sizes to compare (default: 1, 2, 4, ... up to the number of cores)'
+        )
+
+    def handle(self, *args, **options):
+        # A throwaway server key, so benchmarking never writes key files into the project
+        with override_settings(SERVER_PRIVATE_KEY_PEM=None, SERVER_KEY_IN_MEMORY=True):
+            self._benchmark(options)
+
+    def _benchmark(self, options):
+        worker_counts = options['workers'] or self._default_worker_counts()
+
+        device_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        device_public_pem = device_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode()
+
+        self.stdout.write(f"Preparing {options['registrations']} registration envelopes...")
+        envelopes = [
+            self._registration_envelope({
+                'deviceInfo': {'deviceId': f'bench-{i}', 'publicKey': device_public_pem},
+                'authToken': 'x' * 32,
+                'responseEnvelope': 'hybrid'
+            })
+            for i in range(options['registrations'])
+        ]
+
+        def response(registration_data):
+            return encrypt_with_public_key({'sessionKey': 'k' * 64}, device_public_pem, hybrid=True)
+
+        inline = self._run(envelopes, options['concurrency'],
+                           lambda envelope: response(_decrypt_envelope(envelope, get_server_private_key())))
+        self.stdout.write(self.style.MIGRATE_HEADING('inline (CRYPTO_POOL_WORKERS=0)'))
+        self.stdout.write(f'  {inline:.0f} registrations/s')
+
+        for workers in worker_counts:
+            pool = PrivateKeyPool(workers)
+            try:
+                # Start the workers and load their keys before timing
+                self._run(envelopes[:workers * 2], workers, pool.decrypt)
+                rate = self._run(envelopes, options['concurrency'],
+                                 lambda envelope: response(pool.decrypt(envelope)))
+            finally:
+                pool.shutdown()
+
+            self.stdout.write(self.style.MIGRATE_HEADING(f'pool of {workers} (CRYPTO_POOL_WORKERS={workers})'))
+            self.stdout.write(f'  {rate:.0f} registrations/s')
+            self.stdout.write(self.style.SUCCESS(f'  {rate / inline:.2f}x inline'))
+
+    def _default_worker_counts(self):
+        cores = os.cpu_count() or 1
+        counts = []
+        workers = 1
+        while workers < cores:
+            counts.append(workers)
+            workers *= 2
+        counts.append(cores)
+        return counts
+
+    def _run(self, envelopes, concurrency, register):
+        """Registrations per second with `concurrency` request threads"""
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(register, envelopes))
+        return len(envelopes) / (time.perf_counter() - started)
+
+    def _registration_envelope(self, data):
+        """Encrypt a registration payload the way MathDevice does"""
+        json_data = json.dumps(data).encode()
+        aes_key = os.urandom(32)
+        iv = os.urandom(16)
+
+        encryptor = Cipher(algorithms.AES(aes_key), modes.CBC(iv)).encryptor()
+        padding_length = 16 - (len(json_data) % 16)
+        ciphertext = encryptor.update(json_data + bytes([padding_length]) * padding_length) + encryptor.finalize()
+
+        encrypted_key = get_server_public_key().encrypt(
+            aes_key,
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+            )
+        )
+
+        return {
+            'encrypted_key': base64.b64encode(encrypted_key).decode(),
+            'iv': base64.b64encode(iv).decode(),
+            'ciphertext': base64.b64encode(ciphertext).decode()
+        }
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import statistics
+import subprocess
+import tempfile
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from ...crypto import load_server_keys
+
+
+class Command(BaseCommand):
+    help = 'Measure management command startup time and the cost of loading the server key'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--runs',
+            type=int,
+            default=5,
+            help='Startups timed per command (default: 5)'
+        )
+
+    def handle(self, *args, **options):
+        manage_py = os.path.join(settings.BASE_DIR, 'manage.py')
+        key_files = [settings.SERVER_PRIVATE_KEY_PATH, settings.SERVER_PUBLIC_KEY_PATH]
+        existed = {path: os.path.exists(path) for path in key_files}
+
+        self.stdout.write(self.style.MIGRATE_HEADING('startup (median wall time)'))
+        for command in (['check'], ['mark_inactive_devices', '--help']):
+            timings = []
+            for _ in range(options['runs']):
+                started = time.perf_counter()
+                subprocess.run([sys.executable, manage_py, *command], check=True, capture_output=True)
+                timings.append(time.perf_counter() - started)
+            self.stdout.write(f"  manage.py {' '.join(command)}: {statistics.median(timings) * 1000:.0f} ms")
+
+        created = [path for path in key_files if os.path.exists(path) and not existed[path]]
+        if created:
+            self.stdout.write(self.style.WARNING(f"  key files written during startup: {', '.join(map(str, created))}"))
+        else:
+            self.stdout.write(self.style.SUCCESS('  no key files written during startup'))
+
+        # What the first request needing the key pays, by key source
+        self.stdout.write(self.style.MIGRATE_HEADING('first server key use'))
+        with tempfile.TemporaryDirectory() as key_dir:
+            paths = {
+                'SERVER_PRIVATE_KEY_PEM': None,
+                'SERVER_PRIVATE_KEY_PATH': os.path.join(key_dir, 'private.pem'),
+                'SERVER_PUBLIC_KEY_PATH': os.path.join(key_dir, 'public.pem'),
+            }
+            with override_settings(**paths):
+                self._time_load('generate and save to path', options['runs'], cleanup=lambda: [
+                    os.remove(path) for path in (paths['SERVER_PRIVATE_KEY_PATH'], paths['SERVER_PUBLIC_KEY_PATH'])
+                ])
+                load_server_keys()
+                self._time_load('load from path', options['runs'])
+
+                with open(paths['SERVER_PRIVATE_KEY_PATH']) as f:
+                    pem = f.read()
+            with override_settings(SERVER_PRIVATE_KEY_PEM=pem):
+                self._time_load('SERVER_PRIVATE_KEY_PEM', options['runs'])
+            with override_settings(SERVER_PRIVATE_KEY_PEM=None, SERVER_KEY_IN_MEMORY=True):
+                self._time_load('SERVER_KEY_IN_MEMORY', options['runs'])
+
+    def _time_load(self, label, runs, cleanup=None):
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            load_server_keys()
+            timings.append(time.perf_counter() - started)
+            if cleanup:
+                cleanup()
+        self.stdout.write(f'  {label}: {statistics.median(timings) * 1000:.1f} ms')
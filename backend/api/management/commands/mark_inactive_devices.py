@@ -1,4 +1,7 @@
+import time
 from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections
 from django.utils import timezone
 from django.core.management.base import BaseCommand
 from ...models import Device
@@ -11,24 +14,54 @@ class Command(BaseCommand):
         parser.add_argument(
             '--timeout',
             type=int,
-            default=60,
-            help='Timeout in seconds before marking a device as inactive (default: 60)'
+            default=settings.DEVICE_INACTIVE_TIMEOUT,
+            help='Timeout in seconds before marking a device as inactive '
+                 f'(default: {settings.DEVICE_INACTIVE_TIMEOUT})'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Keep running and sweep every --interval seconds'
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=settings.DEVICE_SWEEP_INTERVAL,
+            help=f'Seconds between sweeps in --loop mode (default: {settings.DEVICE_SWEEP_INTERVAL})'
         )
 
     def handle(self, *args, **options):
-        timeout_seconds = options['timeout']
-        timeout_threshold = timezone.now() - timedelta(seconds=timeout_seconds)
+        if not options['loop']:
+            self.sweep(options['timeout'])
+            return
+
+        self.stdout.write(f"Sweeping inactive devices every {options['interval']}s")
+        try:
+            while True:
+                # Drop connections the database may have closed while we slept
+                close_old_connections()
+                try:
+                    self.sweep(options['timeout'])
+                except Exception as e:
+                    self.stderr.write(f'Sweep failed: {str(e)}')
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write('Sweeper stopped')
 
-        # Find devices that haven't sent a heartbeat
-        inactive_devices = Device.objects.filter(
+    def sweep(self, timeout_seconds):
+        if settings.DEVICE_LIVENESS_MODE == 'computed':
+            self.stdout.write('Liveness is computed from last_seen, nothing to sweep')
+            return
+
+        now = timezone.now()
+        timeout_threshold = now - timedelta(seconds=timeout_seconds)
+
+        # Find devices that haven't sent a heartbeat and mark them as inactive
+        count = Device.objects.filter(
             is_active=True,
             last_seen__lt=timeout_threshold
-        )
-
-        # Mark them as inactive
-        count = inactive_devices.count()
-        inactive_devices.update(is_active=False)
+        ).update(is_active=False, updated_at=now)
 
         self.stdout.write(
             self.style.SUCCESS(f'Successfully marked {count} devices as inactive')
-        )
\ No newline at end of file
+        )
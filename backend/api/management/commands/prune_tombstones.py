@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from ...delta import prune_tombstones
+
+
+class Command(BaseCommand):
+    help = 'Delete deletion records older than SYNC_TOMBSTONE_RETENTION'
+
+    def handle(self, *args, **options):
+        count = prune_tombstones()
+        self.stdout.write(self.style.SUCCESS(f'Successfully pruned {count} tombstones'))
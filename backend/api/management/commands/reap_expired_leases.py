@@ -0,0 +1,64 @@
+import time
+from django.conf import settings
+from django.db import close_old_connections
+from django.core.management.base import BaseCommand
+from ...leases import expire_overdue_commands, reap_expired_leases
+
+
+class Command(BaseCommand):
+    help = ('Requeue, reassign or fail sent commands whose device did not report back before the lease '
+            'expired, and fail pending commands past their deadline')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-attempts',
+            type=int,
+            default=settings.COMMAND_MAX_ATTEMPTS,
+            help='Deliveries after which an expired command is failed '
+                 f'(default: {settings.COMMAND_MAX_ATTEMPTS})'
+        )
+        parser.add_argument(
+            '--no-reassign',
+            action='store_true',
+            help='Always requeue on the same device instead of moving to another capable device'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Keep running and reap every --interval seconds'
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=settings.COMMAND_REAP_INTERVAL,
+            help=f'Seconds between runs in --loop mode (default: {settings.COMMAND_REAP_INTERVAL})'
+        )
+
+    def handle(self, *args, **options):
+        if not options['loop']:
+            self.reap(options)
+            return
+
+        self.stdout.write(f"Reaping expired command leases every {options['interval']}s")
+        try:
+            while True:
+                # Drop connections the database may have closed while we slept
+                close_old_connections()
+                try:
+                    self.reap(options)
+                except Exception as e:
+                    self.stderr.write(f'Reaping failed: {str(e)}')
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write('Reaper stopped')
+
+    def reap(self, options):
+        requeued, reassigned, failed = reap_expired_leases(
+            max_attempts=options['max_attempts'],
+            reassign=not options['no_reassign']
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Requeued {requeued}, reassigned {reassigned} and failed {failed} commands with expired leases'
+        ))
+        overdue = expire_overdue_commands()
+        self.stdout.write(self.style.SUCCESS(f'Failed {overdue} pending commands past their deadline'))
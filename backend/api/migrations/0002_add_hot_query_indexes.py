@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='command',
+            index=models.Index(fields=['device', 'status', 'created_at'], name='command_device_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='command',
+            index=models.Index(fields=['device', '-created_at'], name='command_device_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='command',
+            index=models.Index(fields=['-created_at'], name='command_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(fields=['is_active', 'last_seen'], name='device_active_last_seen_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_add_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='command',
+            name='command_device_created_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='command',
+            name='command_created_idx',
+        ),
+        migrations.AddIndex(
+            model_name='command',
+            index=models.Index(fields=['device', '-created_at', '-id'], name='command_device_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='command',
+            index=models.Index(fields=['-created_at', '-id'], name='command_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(fields=['-registered_at', '-id'], name='device_registered_idx'),
+        ),
+    ]
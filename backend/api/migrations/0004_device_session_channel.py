@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='session_channel',
+            field=models.CharField(default='cbc', max_length=16),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_delta_sync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='command',
+            name='batch_id',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='command',
+            index=models.Index(fields=['batch_id', 'status'], name='command_batch_status_idx'),
+        ),
+    ]
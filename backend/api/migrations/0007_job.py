@@ -0,0 +1,65 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:13
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+def batches_to_jobs(apps, schema_editor):
+    """Turn each existing batch into a job with the batch id, counting its commands"""
+    Command = apps.get_model('api', 'Command')
+    Job = apps.get_model('api', 'Job')
+    batch_ids = Command.objects.exclude(batch_id=None).values_list('batch_id', flat=True).distinct()
+    for batch_id in batch_ids:
+        commands = Command.objects.filter(batch_id=batch_id)
+        counts = dict(commands.values_list('status').annotate(count=models.Count('id')))
+        Job.objects.create(
+            id=batch_id,
+            name=commands.values_list('name', flat=True).first(),
+            total=sum(counts.values()),
+            **{status: counts.get(status, 0) for status in ('pending', 'sent', 'completed', 'failed')}
+        )
+        commands.update(job_id=batch_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_command_batch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=50)),
+                ('created_by', models.CharField(blank=True, max_length=255, null=True)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('pending', models.IntegerField(default=0)),
+                ('sent', models.IntegerField(default=0)),
+                ('completed', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='command',
+            name='job',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='commands', to='api.job'),
+        ),
+        migrations.RunPython(batches_to_jobs, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='command',
+            name='command_batch_status_idx',
+        ),
+        migrations.RemoveField(
+            model_name='command',
+            name='batch_id',
+        ),
+        migrations.AddIndex(
+            model_name='command',
+            index=models.Index(fields=['job', 'status'], name='command_job_status_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='command',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='command',
+            name='leased_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='command',
+            index=models.Index(fields=['status', 'leased_until'], name='command_lease_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_command_leases'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='command',
+            name='command_device_status_idx',
+        ),
+        migrations.AddField(
+            model_name='command',
+            name='deadline',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='command',
+            name='priority',
+            field=models.SmallIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='command',
+            index=models.Index(fields=['device', 'status', '-priority', 'created_at'], name='command_claim_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='command',
+            index=models.Index(fields=['status', 'deadline'], name='command_deadline_idx'),
+        ),
+    ]
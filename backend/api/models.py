@@ -1,6 +1,11 @@
 import uuid
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
 class CustomUserManager(BaseUserManager):
@@ -68,6 +73,28 @@ class AuthorizationToken(models.Model):
         return f"Token: {self.token[:10]}... ({'Valid' if self.is_valid else 'Invalid'})"
 
 
+class DeviceQuerySet(models.QuerySet):
+    def _online_q(self):
+        if settings.DEVICE_LIVENESS_MODE == 'computed':
+            # Derive liveness from the last heartbeat; is_active only records deregistration
+            threshold = timezone.now() - timedelta(seconds=settings.DEVICE_INACTIVE_TIMEOUT)
+            return models.Q(is_active=True, last_seen__gte=threshold)
+        return models.Q(is_active=True)
+
+    def with_liveness(self):
+        """Annotate each device with is_online according to DEVICE_LIVENESS_MODE"""
+        return self.annotate(
+            is_online=models.ExpressionWrapper(self._online_q(), output_field=models.BooleanField())
+        )
+
+    def online(self):
+        """Devices that are currently reachable"""
+        return self.filter(self._online_q())
+
+    def offline(self):
+        return self.exclude(self._online_q())
+
+
 class Device(models.Model):
     """Connected device information"""
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -75,16 +102,32 @@ class Device(models.Model):
     device_type = models.CharField(max_length=50)
     public_key = models.TextField()
     session_key = models.CharField(max_length=128)
+    session_channel = models.CharField(max_length=16, default='cbc')  # 'cbc' or 'gcm', see crypto.SESSION_CHANNELS
     capabilities = models.JSONField(default=list)
     metadata = models.JSONField(default=dict)
     is_active = models.BooleanField(default=True)
     registered_at = models.DateTimeField(auto_now_add=True)
     last_seen = models.DateTimeField(auto_now=True)
+    # Bumped by every change except heartbeats; narrow .update() calls must set it themselves
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = DeviceQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Inactive-device sweeps filter on is_active and last_seen
+            models.Index(fields=['is_active', 'last_seen'], name='device_active_last_seen_idx'),
+            # Device listings page by (registered_at, id), newest first
+            models.Index(fields=['-registered_at', '-id'], name='device_registered_idx'),
+            # Delta syncs (?since=) look for devices changed or seen after the cursor
+            models.Index(fields=['updated_at'], name='device_updated_idx'),
+            models.Index(fields=['last_seen'], name='device_last_seen_idx'),
+        ]
 
     def reactivate(self):
         """Explicitly reactivate a device and save it"""
         self.is_active = True
-        self.save(update_fields=['is_active', 'last_seen'])
+        self.save(update_fields=['is_active', 'last_seen', 'updated_at'])
         return self
 
     def __str__(self):
@@ -177,6 +220,153 @@ class ActionParameter(models.Model):
             )
 
 
+class JobQuerySet(models.QuerySet):
+    def record_transitions(self, transitions):
+        """
+        Move commands between the status counters of their jobs.
+
+        `transitions` maps job ids to {status: delta}; each job is updated
+        with one relative UPDATE, so concurrent transitions don't race.
+        """
+        now = timezone.now()
+        for job_id, deltas in transitions.items():
+            changes = {status: models.F(status) + delta for status, delta in deltas.items() if delta}
+            if changes:
+                self.filter(pk=job_id).update(**changes, updated_at=now)
+
+    def recount(self):
+        """Recompute the status counters of these jobs from their commands"""
+        now = timezone.now()
+        for job in self:
+            counts = dict(job.commands.values_list('status').annotate(count=models.Count('id')))
+            self.filter(pk=job.pk).update(
+                total=sum(counts.values()),
+                **{status: counts.get(status, 0) for status in Job.COUNTERS},
+                updated_at=now
+            )
+
+
+class Job(models.Model):
+    """
+    A group of commands queued together through the batch endpoint.
+
+    The per-status counters are kept in step with the commands' status
+    transitions, so progress is read from this row instead of counting
+    the commands. Commands deleted later are still counted.
+    """
+    COUNTERS = ('pending', 'sent', 'completed', 'failed')
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    name = models.CharField(max_length=50)  # The command queued by the job
+    created_by = models.CharField(max_length=255, null=True, blank=True)
+    total = models.PositiveIntegerField(default=0)
+    pending = models.IntegerField(default=0)
+    sent = models.IntegerField(default=0)
+    completed = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = JobQuerySet.as_manager()
+
+    @property
+    def is_finished(self):
+        return self.completed + self.failed >= self.total
+
+    def __str__(self):
+        return f"Job {self.name} ({self.completed + self.failed}/{self.total})"
+
+
+def _transitions(rows, new_status):
+    """{job_id: {status: delta}} for moving (previous_status, job_id) rows to new_status"""
+    transitions = {}
+    for previous_status, job_id in rows:
+        if job_id is None or previous_status == new_status:
+            continue
+        deltas = transitions.setdefault(job_id, {})
+        for status, delta in ((previous_status, -1), (new_status, 1)):
+            if status in Job.COUNTERS:
+                deltas[status] = deltas.get(status, 0) + delta
+    return transitions
+
+
+class CommandQuerySet(models.QuerySet):
+    def claim_pending(self, device, limit):
+        """
+        Atomically mark up to `limit` of the device's pending commands as sent
+        and return them (highest priority first, then oldest) as dicts with
+        id, name and params. Commands past their deadline are skipped; the
+        lease reaper fails them.
+
+        Rows are locked with SKIP LOCKED where the database supports it, so
+        concurrent pollers claim disjoint batches. Without row locks the
+        UPDATE is conditional on the rows still being pending, and when it
+        flips fewer rows than were read, only those carrying this claim's
+        lease are returned, so a row is never delivered twice.
+        Each claim counts as an attempt and leases the command to the device
+        for COMMAND_LEASE_DURATION seconds (see leases.reap_expired_leases).
+        """
+        with transaction.atomic(using=self.db):
+            pending = self.filter(
+                models.Q(deadline=None) | models.Q(deadline__gt=timezone.now()),
+                device=device,
+                status='pending'
+            ).order_by('-priority', 'created_at')
+            if connections[self.db].features.has_select_for_update_skip_locked:
+                pending = pending.select_for_update(skip_locked=True)
+
+            claimed = list(pending.values('id', 'name', 'params', 'job_id')[:limit])
+            if claimed:
+                now = timezone.now()
+                lease = now + timedelta(seconds=settings.COMMAND_LEASE_DURATION)
+                ids = [command['id'] for command in claimed]
+                updated = self.filter(id__in=ids, status='pending').update(
+                    status='sent',
+                    leased_until=lease,
+                    attempts=models.F('attempts') + 1,
+                    updated_at=now
+                )
+
+                if updated < len(claimed):
+                    # Another poller claimed some of them first; keep only ours
+                    ours = set(
+                        self.filter(id__in=ids, status='sent', leased_until=lease).values_list('id', flat=True)
+                    )
+                    claimed = [command for command in claimed if command['id'] in ours]
+
+                Job.objects.record_transitions(
+                    _transitions((('pending', command['job_id']) for command in claimed), 'sent')
+                )
+
+        return claimed
+
+    def record_result(self, command_id, device, status, result):
+        """
+        Set a command's status and result, moving it between its job's
+        counters. Returns the update time, or None when the device has no
+        such command.
+        """
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            while True:
+                current = self.filter(id=command_id, device=device).values_list('status', 'job_id').first()
+                if current is None:
+                    return None
+                # Conditional on the status read, so a concurrent change is not miscounted
+                if self.filter(id=command_id, status=current[0]).update(
+                    status=status,
+                    result=result,
+                    updated_at=now
+                ):
+                    break
+            Job.objects.record_transitions(_transitions([current], status))
+        return now
+
+    async def arecord_result(self, command_id, device, status, result):
+        """record_result() for the async views"""
+        return await sync_to_async(self.record_result)(command_id, device, status, result)
+
+
 class Command(models.Model):
     """Commands sent to devices"""
     STATUS_CHOICES = [
@@ -192,8 +382,64 @@ class Command(models.Model):
     params = models.JSONField()
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     result = models.JSONField(null=True, blank=True)
+    job = models.ForeignKey(Job, on_delete=models.SET_NULL, null=True, blank=True, related_name='commands')
+    # Set when a device claims the command; a 'sent' command past its lease is reaped
+    leased_until = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    # Higher priorities are delivered first; past the deadline a command is no longer delivered
+    priority = models.SmallIntegerField(default=0)
+    deadline = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CommandQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Device polls claim pending commands by priority, then oldest first
+            models.Index(fields=['device', 'status', '-priority', 'created_at'], name='command_claim_idx'),
+            # Per-device and global command history, paged by (created_at, id) newest first
+            models.Index(fields=['device', '-created_at', '-id'], name='command_device_created_idx'),
+            models.Index(fields=['-created_at', '-id'], name='command_created_idx'),
+            # Delta syncs (?since=) look for commands updated after the cursor
+            models.Index(fields=['updated_at'], name='command_updated_idx'),
+            # Job exports and recounts (?job=)
+            models.Index(fields=['job', 'status'], name='command_job_status_idx'),
+            # The lease reaper looks for sent commands whose lease expired
+            models.Index(fields=['status', 'leased_until'], name='command_lease_idx'),
+            # ... and for pending commands past their deadline
+            models.Index(fields=['status', 'deadline'], name='command_deadline_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} on {self.device.device_type} ({self.status})"
+
+
+class Tombstone(models.Model):
+    """A deleted device or command, kept so delta syncs can report the deletion"""
+    KIND_CHOICES = [
+        ('device', 'Device'),
+        ('command', 'Command'),
+    ]
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    object_id = models.CharField(max_length=64)  # device_id for devices, the UUID for commands
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'deleted_at'], name='tombstone_kind_deleted_idx'),
+        ]
+
     def __str__(self):
-        return f"{self.name} on {self.device.device_type} ({self.status})"
\ No newline at end of file
+        return f"Deleted {self.kind} {self.object_id}"
+
+
+@receiver(post_delete, sender=Device)
+def _record_device_deletion(sender, instance, **kwargs):
+    Tombstone.objects.create(kind='device', object_id=instance.device_id)
+
+
+@receiver(post_delete, sender=Command)
+def _record_command_deletion(sender, instance, **kwargs):
+    Tombstone.objects.create(kind='command', object_id=str(instance.id))
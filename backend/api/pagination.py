@@ -0,0 +1,59 @@
+import base64
+import uuid
+from datetime import datetime
+from django.conf import settings
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    """Raised when a client sends a cursor or page size we cannot use"""
+
+
+def encode_cursor(timestamp, pk):
+    """Build an opaque cursor pointing just past the given row"""
+    raw = f"{timestamp.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Split a cursor back into its (timestamp, pk) pair; the listed models all have UUID keys"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, pk = raw.split('|', 1)
+        return datetime.fromisoformat(timestamp), uuid.UUID(pk)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+
+def paginate_keyset(queryset, request, time_field, default_limit=None):
+    """
+    Return one page of `queryset`, newest first, and the cursor of the next page.
+
+    Pages are addressed by (time_field, id) instead of OFFSET, so every page
+    costs the same index range scan no matter how deep the client pages.
+    The page size comes from ?limit= and the position from ?cursor=.
+    """
+    try:
+        limit = int(request.query_params.get('limit', default_limit or settings.API_PAGE_SIZE))
+    except ValueError as e:
+        raise InvalidCursor("Invalid limit value") from e
+    limit = min(max(limit, 1), settings.API_MAX_PAGE_SIZE)
+
+    queryset = queryset.order_by(f'-{time_field}', '-id')
+
+    cursor = request.query_params.get('cursor')
+    if cursor:
+        timestamp, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(**{f'{time_field}__lt': timestamp}) | Q(**{time_field: timestamp, 'id__lt': pk})
+        )
+
+    # Fetch one extra row to learn whether another page exists
+    items = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, time_field), last.pk)
+
+    return items, next_cursor
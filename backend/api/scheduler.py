@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Command, Device
+
+logger = logging.getLogger(__name__)
+
+# Command statuses that still occupy a device
+OUTSTANDING_STATUSES = ('pending', 'sent')
+
+
+class CapabilityIndex:
+    """
+    Process-local index of capability -> registered device pks.
+
+    Registrations in this process update it through add(); it is rebuilt
+    from the database every SCHEDULER_INDEX_TTL seconds to pick up devices
+    registered through other server processes. Liveness is not tracked
+    here: the scheduler filters the candidates with Device.objects.online().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices = {}  # pk -> capabilities
+        self._by_capability = {}  # capability -> set of pks
+        self._expires_at = 0
+
+    def devices_with(self, capability):
+        """The pks of the active devices advertising `capability`"""
+        if time.monotonic() >= self._expires_at:
+            self.refresh()
+        with self._lock:
+            return set(self._by_capability.get(capability, ()))
+
+    def add(self, device_pk, capabilities):
+        """Record a (re-)registered device and its current capabilities"""
+        with self._lock:
+            self._remove(device_pk)
+            self._devices[device_pk] = list(capabilities)
+            for capability in capabilities:
+                self._by_capability.setdefault(capability, set()).add(device_pk)
+
+    def refresh(self):
+        """Rebuild the index from the active devices"""
+        rows = Device.objects.filter(is_active=True).values_list('pk', 'capabilities')
+        devices, by_capability = {}, {}
+        for device_pk, capabilities in rows:
+            devices[device_pk] = capabilities
+            for capability in capabilities:
+                by_capability.setdefault(capability, set()).add(device_pk)
+
+        with self._lock:
+            self._devices = devices
+            self._by_capability = by_capability
+            self._expires_at = time.monotonic() + settings.SCHEDULER_INDEX_TTL
+        logger.debug(f"Capability index rebuilt: {len(devices)} devices, {len(by_capability)} capabilities")
+
+    def clear(self):
+        with self._lock:
+            self._devices.clear()
+            self._by_capability.clear()
+            self._expires_at = 0
+
+    def _remove(self, device_pk):
+        for capability in self._devices.pop(device_pk, ()):
+            device_pks = self._by_capability.get(capability)
+            if device_pks is not None:
+                device_pks.discard(device_pk)
+                if not device_pks:
+                    del self._by_capability[capability]
+
+
+def least_loaded_device(capability, exclude=None):
+    """
+    The online device advertising `capability` with the fewest outstanding
+    (pending or sent) commands, or None when there is none. `exclude` is a
+    device pk to leave out, e.g. the device a command is taken away from.
+
+    Load is counted in the database so it covers commands queued by every
+    server process; ties go to the device seen most recently. The count is a
+    correlated subquery per candidate, served from command_claim_idx, rather
+    than a join that would group every outstanding command of the fleet.
+    """
+    candidates = capability_index.devices_with(capability) - {exclude}
+    if not candidates:
+        return None
+
+    outstanding = (
+        Command.objects.filter(device=OuterRef('pk'), status__in=OUTSTANDING_STATUSES)
+        .order_by()
+        .values('device')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    return (
+        Device.objects.online()
+        .filter(pk__in=candidates)
+        .annotate(load=Coalesce(Subquery(outstanding), 0))
+        .order_by('load', '-last_seen')
+        .only('id', 'device_id', 'device_type', 'capabilities')
+        .first()
+    )
+
+
+# Process-wide index shared by the views
+capability_index = CapabilityIndex()
@@ -1,3 +1,958 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import os
+import re
+import time
+from contextlib import aclosing
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import async_views
+from .crypto import (
+    GcmSessionCipher, decrypt_with_session_key, encrypt_with_session_key, get_server_public_key,
+    get_server_public_key_pem
+)
+from .device_cache import DeviceCache, device_cache
+from .dispatch import command_notifier
+from .heartbeats import HeartbeatBuffer
+from .leases import expire_overdue_commands, reap_expired_leases
+from .models import User, AuthorizationToken, ActionParameter, Device, Command, CommandQuerySet, Job
+from .scheduler import capability_index
+
+
+def create_device(device_id='device-1', **fields):
+    """A registered calculator supporting 'add', with placeholder keys unless overridden"""
+    return Device.objects.create(**{
+        'device_id': device_id,
+        'device_type': 'calculator',
+        'public_key': '-',
+        'session_key': '-',
+        'capabilities': ['add'],
+        **fields
+    })
+
+
+OAEP = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+
+
+def generate_device_key():
+    """A simulated device's RSA key and its public key PEM"""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public_key_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
+    return private_key, public_key_pem
+
+
+def registration_envelope(data):
+    """Seal registration data for the server the way MathDevice does: an RSA-wrapped AES-CBC key"""
+    aes_key, iv = os.urandom(32), os.urandom(16)
+    plaintext = json.dumps(data).encode()
+    padding_length = 16 - len(plaintext) % 16
+    encryptor = Cipher(algorithms.AES(aes_key), modes.CBC(iv)).encryptor()
+    ciphertext = encryptor.update(plaintext + bytes([padding_length]) * padding_length) + encryptor.finalize()
+    return {
+        'encrypted_key': base64.b64encode(get_server_public_key().encrypt(aes_key, OAEP)).decode(),
+        'iv': base64.b64encode(iv).decode(),
+        'ciphertext': base64.b64encode(ciphertext).decode()
+    }
+
+
+def open_hybrid_envelope(envelope, private_key):
+    """Open a response sealed with encrypt_with_public_key(..., hybrid=True)"""
+    aes_key = private_key.decrypt(base64.b64decode(envelope['encrypted_key']), OAEP)
+    plaintext = AESGCM(aes_key).decrypt(
+        base64.b64decode(envelope['nonce']), base64.b64decode(envelope['ciphertext']), None
+    )
+    return json.loads(plaintext)
+
+
+class DeviceRegistrationMixin:
+    """Registers the simulated device 'device-1' through the registration endpoint"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.private_key, cls.public_key_pem = generate_device_key()
+
+    def setUp(self):
+        device_cache.clear()
+        capability_index.clear()
+        self.client = APIClient()
+        AuthorizationToken.objects.create(token='t' * 32, expires_at=timezone.now() + timedelta(hours=1))
+        ActionParameter.objects.create(action_name='add', parameters=['num1', 'num2'], description='Add')
+
+    def register(self, url='/api/register-device/', **options):
+        """Register with the given negotiation options, returning the opened response"""
+        response = self.client.post(url, {'data': registration_envelope({
+            'deviceInfo': {
+                'deviceId': 'device-1',
+                'publicKey': self.public_key_pem,
+                'metadata': {'type': 'calculator'},
+                'operations': ['add']
+            },
+            'authToken': 't' * 32,
+            'responseEnvelope': 'hybrid',
+            **options
+        })}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return open_hybrid_envelope(response.data, self.private_key)
+
+
+class CommandHistoryQueryCountTests(TestCase):
+    """The command history endpoints must not issue a query per command"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='admin@example.com', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        self.devices = [create_device(f'device-{i}') for i in range(5)]
+        for i in range(50):
+            Command.objects.create(
+                device=self.devices[i % 5],
+                name='add',
+                params={'num1': i, 'num2': i}
+            )
+
+    def test_get_all_commands_query_count_is_constant(self):
+        # ETag fingerprint, latest deletion, then the page itself
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/commands/all/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['commands']), 50)
+        self.assertEqual(response.data['commands'][0]['deviceType'], 'calculator')
+
+    @override_settings(SYNC_CURSOR_LAG=0)
+    def test_get_all_commands_since_returns_only_changes(self):
+        response = self.client.get('/api/commands/all/')
+        self.assertEqual(
+            self.client.get('/api/commands/all/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304
+        )
+
+        changed, deleted = Command.objects.all()[:2]
+        Command.objects.filter(pk=changed.pk).update(status='completed', updated_at=timezone.now())
+        deleted_id = str(deleted.id)
+        deleted.delete()
+
+        delta = self.client.get('/api/commands/all/', {'since': response.data['since']})
+        self.assertEqual([c['id'] for c in delta.data['commands']], [str(changed.id)])
+        self.assertEqual(delta.data['deleted'], [deleted_id])
+
+    @override_settings(SYNC_CURSOR_LAG=0)
+    def test_filtered_listing_reports_rows_leaving_the_filter(self):
+        params = {'status': 'pending'}
+        response = self.client.get('/api/commands/all/', params)
+
+        # Not the latest row, so the filtered rows' latest update stays the same
+        moved = Command.objects.order_by('updated_at').first()
+        Command.objects.filter(pk=moved.pk).update(status='sent', updated_at=timezone.now())
+
+        replay = self.client.get('/api/commands/all/', params, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(len(replay.data['commands']), 49)
+
+        delta = self.client.get('/api/commands/all/', {**params, 'since': response.data['since']})
+        self.assertEqual((delta.data['commands'], delta.data['removed']), ([], [str(moved.id)]))
+
+    def test_malformed_since_is_rejected(self):
+        naive = base64.urlsafe_b64encode(f'since|{timezone.now().replace(tzinfo=None).isoformat()}'.encode()).decode()
+        for url in ('/api/devices/all/', '/api/commands/all/'):
+            for since in (naive, 'garbage'):
+                self.assertEqual(self.client.get(url, {'since': since}).status_code, 400, (url, since))
+
+    def test_get_command_status_uses_single_query(self):
+        command = Command.objects.first()
+
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/commands/{command.id}/status/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['deviceId'], command.device.device_id)
+
+
+class PaginationTests(TestCase):
+    """Listings page by ?cursor= and ?limit=, newest first, and reject malformed cursors"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='admin@example.com', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        for i in range(5):
+            device = create_device(f'device-{i}', device_type='calculator' if i % 2 else 'python')
+            Command.objects.create(device=device, name='add', params={'num1': i, 'num2': i})
+
+    def _pages(self, url, key, **params):
+        pages, cursor = [], None
+        while True:
+            response = self.client.get(url, {**params, **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200)
+            pages.append([item['deviceId'] for item in response.data[key]])
+            cursor = response.data['nextCursor']
+            if not cursor:
+                return pages
+
+    def test_cursor_walks_every_row_once_newest_first(self):
+        for url, key in (('/api/devices/', 'devices'), ('/api/commands/all/', 'commands')):
+            pages = self._pages(url, key, limit=2)
+            self.assertEqual([len(page) for page in pages], [2, 2, 1])
+            self.assertEqual(sum(pages, []), [f'device-{i}' for i in reversed(range(5))])
+
+    def test_filters_apply_across_pages(self):
+        pages = self._pages('/api/devices/all/', 'devices', limit=1, name='python')
+        self.assertEqual(sum(pages, []), ['device-4', 'device-2', 'device-0'])
+
+    def test_device_commands_match_the_command_history(self):
+        history = self.client.get('/api/commands/all/', {'device': 'device-1'}).data['commands']
+        self.assertEqual(self._pages('/api/devices/device-1/commands/', 'commands', limit=1), [['device-1']])
+        self.assertEqual(self.client.get('/api/devices/device-1/commands/').data['commands'], history)
+
+        silent_since = timezone.now() - timedelta(seconds=settings.DEVICE_INACTIVE_TIMEOUT + 1)
+        Device.objects.filter(device_id='device-1').update(last_seen=silent_since)
+        self.assertEqual(self.client.get('/api/devices/device-1/commands/').status_code, 404)
+
+    def test_malformed_cursor_and_limit_are_rejected(self):
+        bad_id = base64.urlsafe_b64encode(f'{timezone.now().isoformat()}|not-a-uuid'.encode()).decode()
+        for url in ('/api/devices/', '/api/devices/all/', '/api/commands/all/'):
+            for params in ({'cursor': bad_id}, {'cursor': 'garbage'}, {'limit': 'ten'}):
+                self.assertEqual(self.client.get(url, params).status_code, 400, (url, params))
+
+
+@override_settings(HEARTBEAT_FLUSH_INTERVAL=0, COMMAND_LONG_POLL_RECHECK_INTERVAL=0.1)
+class LongPollTests(TestCase):
+    """?wait= holds the poll open, re-checking at the recheck interval rather than spinning"""
+
+    def setUp(self):
+        device_cache.clear()
+        self.client = APIClient()
+        self.device = create_device(session_key='a' * 64)
+
+    def _poll(self, **params):
+        return self.client.get('/api/devices/device-1/pending-commands/', params)
+
+    def test_non_finite_wait_is_rejected(self):
+        for wait in ('nan', 'inf', '-inf'):
+            self.assertEqual(self._poll(wait=wait).status_code, 400)
+
+    def test_async_poll_rejects_non_finite_wait(self):
+        for wait in ('nan', 'inf'):
+            response = async_to_sync(AsyncClient().get)(
+                '/api/async/devices/device-1/pending-commands/', {'wait': wait}
+            )
+            self.assertEqual(response.status_code, 400)
+
+    def test_empty_poll_waits_and_rechecks_periodically(self):
+        started = time.monotonic()
+        with CaptureQueriesContext(connection) as queries:
+            response = self._poll(wait=0.3)
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual(decrypt_with_session_key(response.data['data'], self.device.session_key)['commands'], [])
+        claims = [q for q in queries.captured_queries if q['sql'].startswith('SELECT "api_command"')]
+        self.assertLessEqual(len(claims), 5)
+
+    def test_queued_command_is_returned_without_waiting(self):
+        Command.objects.create(device=self.device, name='add', params={'num1': 1, 'num2': 2})
+
+        started = time.monotonic()
+        response = self._poll(wait=5)
+
+        self.assertLess(time.monotonic() - started, 1)
+        commands = decrypt_with_session_key(response.data['data'], self.device.session_key)['commands']
+        self.assertEqual([command['name'] for command in commands], ['add'])
+
+
+@override_settings(HEARTBEAT_FLUSH_INTERVAL=0, COMMAND_LONG_POLL_RECHECK_INTERVAL=0.1)
+class CommandStreamTests(TestCase):
+    """Commands claimed by the event stream reach the device; WSGI refuses the stream"""
+
+    url = '/api/async/devices/device-1/stream/'
+
+    def setUp(self):
+        device_cache.clear()
+        self.device = create_device(session_key='a' * 64)
+        self.auth = encrypt_with_session_key({'deviceId': 'device-1', 'timestamp': time.time()}, 'a' * 64)
+
+    def test_claimed_commands_are_delivered(self):
+        command = Command.objects.create(device=self.device, name='add', params={'num1': 1, 'num2': 2})
+
+        # Django does not close the view's generator when the response is closed, so keep hold of it
+        streams, real_command_events = [], async_views._command_events
+
+        def command_events(device):
+            streams.append(real_command_events(device))
+            return streams[-1]
+
+        async def first_commands_event():
+            response = await AsyncClient().get(self.url, headers={'X-Device-Auth': self.auth})
+            self.assertEqual(response.status_code, 200)
+            try:
+                async with aclosing(response.streaming_content) as events:
+                    async for chunk in events:
+                        event = chunk.decode()
+                        if event.startswith('event: commands'):
+                            return event
+            finally:
+                for stream in streams:
+                    await stream.aclose()
+
+        with mock.patch.object(async_views, '_command_events', command_events):
+            event = async_to_sync(first_commands_event)()
+        data = event.split('data: ', 1)[1].strip()
+        commands = decrypt_with_session_key(data, self.device.session_key)['commands']
+        self.assertEqual([c['id'] for c in commands], [str(command.id)])
+        command.refresh_from_db()
+        self.assertEqual(command.status, 'sent')
+
+    def test_wsgi_request_is_refused_without_claiming(self):
+        command = Command.objects.create(device=self.device, name='add', params={'num1': 1, 'num2': 2})
+
+        response = APIClient().get(self.url, HTTP_X_DEVICE_AUTH=self.auth)
+
+        self.assertEqual(response.status_code, 503)
+        command.refresh_from_db()
+        self.assertEqual(command.status, 'pending')
+
+    def test_notify_drops_listeners_whose_loop_is_gone(self):
+        async def listen_without_leaving():
+            await command_notifier.alisten(self.device.pk).__aenter__()
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(listen_without_leaving())
+        loop.close()
+
+        command_notifier.notify(self.device.pk)
+        self.assertNotIn(self.device.pk, command_notifier._listeners)
+
+
+class DeviceCacheStalenessTests(TestCase):
+    """A session key changed through another server process is picked up without waiting for the TTL"""
+
+    def setUp(self):
+        self.device = create_device(session_key='a' * 64)
+        # Two caches stand in for the caches of two server processes
+        self.worker_a, self.worker_b = DeviceCache(), DeviceCache()
+
+    def _reconnect_through_worker_a(self):
+        Device.objects.filter(pk=self.device.pk).update(session_key='b' * 64)
+        self.worker_a.invalidate('device-1')
+
+    @override_settings(
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'devices': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'device-cache-test'},
+        },
+        DEVICE_CACHE_ALIAS='devices'
+    )
+    def test_invalidation_reaches_other_processes_through_the_shared_tier(self):
+        self.assertEqual(self.worker_b.get('device-1').session_key, 'a' * 64)
+
+        self._reconnect_through_worker_a()
+
+        self.assertEqual(self.worker_b.get('device-1').session_key, 'b' * 64)
+
+    def test_decrypt_failure_rereads_the_device_once(self):
+        stale = self.worker_b.get('device-1')
+        self._reconnect_through_worker_a()
+        payload = encrypt_with_session_key({'status': 'completed'}, 'b' * 64)
+
+        credentials, data = self.worker_b.decrypt(stale, encrypted_data=payload)
+
+        self.assertEqual((credentials.session_key, data['status']), ('b' * 64, 'completed'))
+        self.assertEqual(self.worker_b.get('device-1').session_key, 'b' * 64)
+        with self.assertRaises(Exception):
+            self.worker_b.decrypt(credentials, encrypted_data=encrypt_with_session_key({}, 'c' * 64))
+
+
+class CommandBatchTests(TestCase):
+    """The batch endpoint queues many commands with a constant number of queries"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='admin@example.com', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        Device.objects.bulk_create([
+            Device(
+                device_id=f'device-{i}',
+                device_type='calculator' if i % 2 else 'python',
+                public_key='-',
+                session_key='-',
+                capabilities=['add'] if i % 3 else ['add', 'execute_code']
+            )
+            for i in range(30)
+        ])
+
+    def test_selector_fans_out_to_supporting_devices(self):
+        with self.assertNumQueries(5):
+            response = self.client.post('/api/commands/batch/', {
+                'command': 'execute_code',
+                'params': {'code': 'print(1)'},
+                'selector': {'deviceType': 'python'}
+            }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['count'], response.data['skipped']), (5, 10))
+        job = Job.objects.get(id=response.data['jobId'])
+        self.assertEqual((job.total, job.pending), (5, 5))
+        self.assertFalse(job.commands.exclude(device__device_type='python').exists())
+
+    def test_invalid_entry_rejects_the_whole_list(self):
+        response = self.client.post('/api/commands/batch/', {'commands': [
+            {'deviceId': 'device-1', 'command': 'add', 'params': {'num1': 1, 'num2': 2}},
+            {'deviceId': 'device-1', 'command': 'execute_code', 'params': {'code': 'print(1)'}},
+            {'deviceId': 'missing', 'command': 'add'}
+        ]}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2])
+        self.assertFalse(Command.objects.exists())
+
+    def test_non_string_device_id_is_rejected(self):
+        response = self.client.post('/api/commands/batch/', {'commands': [
+            {'deviceId': ['device-1'], 'command': 'add', 'params': {'num1': 1, 'num2': 2}},
+            {'deviceId': {'id': 'device-1'}, 'command': 'add', 'params': {'num1': 1, 'num2': 2}}
+        ]}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['index'] for error in response.data['errors']], [0, 1])
+
+
+class SchedulerTests(TestCase):
+    """Commands without a deviceId go to the least-loaded capable online device"""
+
+    def setUp(self):
+        capability_index.clear()
+        self.user = User.objects.create_user(email='admin@example.com', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        for device_id, capabilities, is_active in [
+            ('busy', ['add', 'multiply'], True),
+            ('idle', ['add', 'multiply'], True),
+            ('adder', ['add'], True),
+            ('offline', ['multiply'], False),
+        ]:
+            create_device(device_id, capabilities=capabilities, is_active=is_active)
+        busy = Device.objects.get(device_id='busy')
+        Command.objects.create(device=busy, name='multiply', params={'num1': 1, 'num2': 2})
+
+    def _submit(self, command):
+        return self.client.post('/api/execute-command/', {
+            'command': command,
+            'params': {'num1': 2, 'num2': 3}
+        }, format='json')
+
+    def test_routes_to_least_loaded_capable_device(self):
+        self.assertEqual(self._submit('multiply').data['deviceId'], 'idle')
+        # Both capable devices now hold one outstanding command
+        self.assertIn(self._submit('multiply').data['deviceId'], {'busy', 'idle'})
+        self.assertEqual(Command.objects.filter(device__device_id='offline').count(), 0)
+
+    def test_no_capable_device(self):
+        self.assertEqual(self._submit('divide').status_code, 404)
+
+
+class LivenessTests(TestCase):
+    """By default devices go offline once their heartbeats stop, without any sweep running"""
+
+    def setUp(self):
+        capability_index.clear()
+        self.user = User.objects.create_user(email='admin@example.com', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        create_device('alive')
+        create_device('silent')
+        silent_since = timezone.now() - timedelta(seconds=settings.DEVICE_INACTIVE_TIMEOUT + 1)
+        Device.objects.filter(device_id='silent').update(last_seen=silent_since)
+
+    def test_silent_device_is_listed_offline_and_gets_no_work(self):
+        devices = self.client.get('/api/devices/all/').data['devices']
+        self.assertEqual({d['deviceId']: d['isActive'] for d in devices}, {'alive': True, 'silent': False})
+
+        for _ in range(3):
+            response = self.client.post('/api/execute-command/', {
+                'command': 'add',
+                'params': {'num1': 2, 'num2': 3}
+            }, format='json')
+            self.assertEqual(response.data['deviceId'], 'alive')
+
+    def _online(self):
+        return set(Device.objects.online().values_list('device_id', flat=True))
+
+    def test_sweep_writes_nothing_and_a_heartbeat_brings_the_device_back(self):
+        with CaptureQueriesContext(connection) as queries:
+            call_command('mark_inactive_devices', stdout=StringIO())
+        self.assertEqual(len(queries), 0)
+        self.assertTrue(Device.objects.get(device_id='silent').is_active)
+
+        device_cache.clear()
+        with override_settings(HEARTBEAT_FLUSH_INTERVAL=0):
+            self.client.post('/api/devices/silent/heartbeat/', {}, format='json')
+
+        self.assertEqual(self._online(), {'alive', 'silent'})
+
+    @override_settings(DEVICE_LIVENESS_MODE='stored')
+    def test_stored_mode_waits_for_the_sweep(self):
+        self.assertEqual(self._online(), {'alive', 'silent'})
+
+        call_command('mark_inactive_devices', stdout=StringIO())
+
+        self.assertEqual(self._online(), {'alive'})
+        self.assertFalse(Device.objects.get(device_id='silent').is_active)
+
+
+@override_settings(HEARTBEAT_FLUSH_INTERVAL=0)
+class JobProgressTests(TestCase):
+    """Job counters follow the status transitions of its commands"""
+
+    def setUp(self):
+        device_cache.clear()
+        self.client = APIClient()
+        self.device = create_device(session_key='a' * 64)
+        self.job = Job.objects.create(name='add', total=3, pending=3)
+        Command.objects.bulk_create([
+            Command(device=self.device, job=self.job, name='add', params={'num1': i, 'num2': i})
+            for i in range(3)
+        ])
+
+    def test_claim_and_results_move_counters(self):
+        self.client.get('/api/devices/device-1/pending-commands/', {'limit': 2})
+        command = Command.objects.filter(status='sent').first()
+        self.client.post(f'/api/commands/{command.id}/update/', {
+            'deviceId': 'device-1',
+            'data': encrypt_with_session_key({'status': 'completed', 'result': 2}, self.device.session_key)
+        }, format='json')
+
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.pending, self.job.sent, self.job.completed, self.job.failed), (1, 1, 1, 0))
+
+    def test_results_export_streams_under_wsgi_and_asgi(self):
+        user = User.objects.create_user(email='admin@example.com', password='secret')
+        url = f'/api/jobs/{self.job.id}/results/'
+
+        self.client.force_authenticate(user)
+        wsgi_lines = b''.join(self.client.get(url).streaming_content).decode().splitlines()
+
+        async def export():
+            response = await AsyncClient().get(url, headers={'Authorization': f'Bearer {AccessToken.for_user(user)}'})
+            # A sync iterator would be read into memory by the ASGI handler
+            self.assertTrue(response.is_async)
+            return b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+        self.assertEqual(len(wsgi_lines), 3)
+        self.assertEqual(async_to_sync(export)().splitlines(), wsgi_lines)
+
+    def test_claim_returns_only_rows_it_flipped(self):
+        taken = Command.objects.order_by('created_at').first()
+        update = CommandQuerySet.update
+
+        def racing_update(queryset, **kwargs):
+            # Another poller flips one of the rows between our read and our UPDATE
+            if kwargs.get('status') == 'sent' and not Command.objects.filter(pk=taken.pk, status='sent').exists():
+                update(Command.objects.filter(pk=taken.pk), status='sent', leased_until=timezone.now())
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(CommandQuerySet, 'update', racing_update):
+            claimed = Command.objects.claim_pending(self.device.pk, 3)
+
+        self.assertEqual(len(claimed), 2)
+        self.assertNotIn(taken.pk, [command['id'] for command in claimed])
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.pending, self.job.sent), (1, 2))
+
+
+@override_settings(HEARTBEAT_FLUSH_INTERVAL=0)
+class LeaseReaperTests(TestCase):
+    """Commands whose lease expired are handed out again, up to COMMAND_MAX_ATTEMPTS"""
+
+    def setUp(self):
+        capability_index.clear()
+        self.devices = [create_device(f'device-{i}') for i in range(2)]
+        self.job = Job.objects.create(name='add', total=1, pending=1)
+        self.command = Command.objects.create(device=self.devices[0], job=self.job, name='add', params={})
+
+    def _claim_and_expire(self):
+        Command.objects.claim_pending(self.devices[0].pk, 1)
+        Command.objects.filter(pk=self.command.pk).update(leased_until=timezone.now() - timedelta(seconds=1))
+
+    def test_expired_lease_is_reassigned_to_another_device(self):
+        self._claim_and_expire()
+
+        self.assertEqual(reap_expired_leases(), (0, 1, 0))
+        self.command.refresh_from_db()
+        self.job.refresh_from_db()
+        self.assertEqual((self.command.status, self.command.device_id), ('pending', self.devices[1].pk))
+        self.assertEqual((self.job.pending, self.job.sent), (1, 0))
+
+    def test_command_fails_after_max_attempts(self):
+        self._claim_and_expire()
+
+        self.assertEqual(reap_expired_leases(max_attempts=1), (0, 0, 1))
+        self.command.refresh_from_db()
+        self.job.refresh_from_db()
+        self.assertEqual((self.command.status, self.command.attempts), ('failed', 1))
+        self.assertEqual((self.job.sent, self.job.failed), (0, 1))
+
+
+class CommandPriorityTests(TestCase):
+    """Claims deliver by priority then age, and never past the deadline"""
+
+    def test_claim_order_and_deadline(self):
+        device = create_device()
+        now = timezone.now()
+        for label, priority, deadline in [
+            ('old', 0, None),
+            ('urgent', 10, None),
+            ('overdue', 20, now - timedelta(seconds=1)),
+            ('new', 0, now + timedelta(minutes=5)),
+        ]:
+            Command.objects.create(device=device, name='add', params={'label': label}, priority=priority, deadline=deadline)
+
+        claimed = Command.objects.claim_pending(device.pk, 10)
+
+        self.assertEqual([command['params']['label'] for command in claimed], ['urgent', 'old', 'new'])
+        self.assertEqual(expire_overdue_commands(), 1)
+        self.assertEqual(Command.objects.get(params__label='overdue').status, 'failed')
+
+
+@override_settings(HEARTBEAT_FLUSH_INTERVAL=0)
+class NarrowUpdateTests(TestCase):
+    """Hot-path writes must only touch the columns they change"""
+
+    @classmethod
+    def setUpTestData(cls):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        cls.public_key_pem = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode()
+
+    def setUp(self):
+        device_cache.clear()
+        self.client = APIClient()
+        self.device = create_device(
+            public_key=self.public_key_pem,
+            session_key='a' * 64,
+            metadata={'type': 'calculator'}
+        )
+
+    def _updated_columns(self, queries, table):
+        """Map each UPDATE on `table` to the set of columns it writes"""
+        columns = []
+        for query in queries.captured_queries:
+            sql = query['sql']
+            if not sql.startswith(f'UPDATE "{table}"'):
+                continue
+            set_clause = sql.split(' SET ', 1)[1].split(' WHERE ', 1)[0]
+            columns.append(set(re.findall(r'"(\w+)" = ', set_clause)))
+        return columns
+
+    def test_heartbeat_writes_only_last_seen(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/devices/device-1/heartbeat/', {}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._updated_columns(queries, 'api_device'), [{'last_seen'}])
+
+    def test_heartbeat_reactivation_writes_only_flag_and_timestamps(self):
+        Device.objects.filter(pk=self.device.pk).update(is_active=False)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post('/api/devices/device-1/heartbeat/', {}, format='json')
+
+        self.assertEqual(self._updated_columns(queries, 'api_device'), [{'is_active', 'last_seen', 'updated_at'}])
+
+    def test_deregister_writes_only_active_flag_and_timestamp(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/devices/device-1/deregister/', {}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._updated_columns(queries, 'api_device'), [{'is_active', 'updated_at'}])
+
+    def test_reconnect_writes_only_session_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/reconnect-device/', {
+                'deviceId': 'device-1',
+                'publicKey': self.public_key_pem
+            }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self._updated_columns(queries, 'api_device'),
+            [{'session_key', 'session_channel', 'is_active', 'last_seen', 'updated_at'}]
+        )
+
+    def test_pending_commands_write_only_claim_columns_and_last_seen(self):
+        Command.objects.create(device=self.device, name='add', params={'num1': 1, 'num2': 2})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/devices/device-1/pending-commands/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._updated_columns(queries, 'api_device'), [{'last_seen'}])
+        self.assertEqual(
+            self._updated_columns(queries, 'api_command'),
+            [{'status', 'leased_until', 'attempts', 'updated_at'}]
+        )
+
+    def test_command_update_writes_only_status_result_and_timestamp(self):
+        command = Command.objects.create(device=self.device, name='add', params={'num1': 1, 'num2': 2})
+        encrypted = encrypt_with_session_key({'status': 'completed', 'result': 3}, self.device.session_key)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(f'/api/commands/{command.id}/update/', {
+                'deviceId': 'device-1',
+                'data': encrypted
+            }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self._updated_columns(queries, 'api_command'),
+            [{'status', 'result', 'updated_at'}]
+        )
+        self.assertEqual(self._updated_columns(queries, 'api_device'), [{'last_seen'}])
+
+
+@override_settings(SERVER_PRIVATE_KEY_PEM=None, SERVER_KEY_IN_MEMORY=True)
+class HybridEnvelopeTests(DeviceRegistrationMixin, TestCase):
+    """(Re)connection answers in an RSA-wrapped AES-GCM envelope for devices asking for it"""
+
+    def test_registration_response_is_sealed_for_the_device(self):
+        body = self.register()
+
+        self.assertEqual(body['sessionKey'], Device.objects.get(device_id='device-1').session_key)
+        self.assertEqual(body['actions'], {'add': {'parameters': ['num1', 'num2'], 'description': 'Add'}})
+
+    def test_reconnect_response_is_sealed_for_the_device(self):
+        self.register()
+
+        response = self.client.post('/api/reconnect-device/', {
+            'deviceId': 'device-1',
+            'publicKey': self.public_key_pem,
+            'responseEnvelope': 'hybrid'
+        }, format='json')
+
+        body = open_hybrid_envelope(response.data, self.private_key)
+        self.assertEqual(body['sessionKey'], Device.objects.get(device_id='device-1').session_key)
+
+    def test_devices_not_asking_get_the_plain_rsa_response(self):
+        response = self.client.post('/api/register-device/', {'data': registration_envelope({
+            'deviceInfo': {'deviceId': 'device-1', 'publicKey': self.public_key_pem, 'operations': ['add']},
+            'authToken': 't' * 32
+        })}, format='json')
+
+        body = json.loads(self.private_key.decrypt(base64.b64decode(response.data), OAEP))
+        self.assertEqual(body['sessionKey'], Device.objects.get(device_id='device-1').session_key)
+        self.assertNotIn('actions', body)
+
+    def test_undecryptable_registration_is_rejected(self):
+        envelope = registration_envelope({'authToken': 't' * 32})
+        envelope['encrypted_key'] = base64.b64encode(os.urandom(256)).decode()
+
+        self.assertEqual(self.client.post('/api/register-device/', {'data': envelope}, format='json').status_code, 400)
+        response = async_to_sync(AsyncClient().post)(
+            '/api/async/register-device/', {'data': envelope}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Device.objects.exists())
+
+
+@override_settings(SERVER_PRIVATE_KEY_PEM=None, SERVER_KEY_IN_MEMORY=True, HEARTBEAT_FLUSH_INTERVAL=0)
+class GcmSessionChannelTests(DeviceRegistrationMixin, TestCase):
+    """Devices negotiating 'gcm' exchange commands and results over AES-GCM"""
+
+    def setUp(self):
+        super().setUp()
+        body = self.register(sessionChannels=['gcm', 'cbc'])
+        self.assertEqual(body['sessionChannel'], 'gcm')
+        self.cipher = GcmSessionCipher(body['sessionKey'])
+        self.device = Device.objects.get(device_id='device-1')
+        self.command = Command.objects.create(device=self.device, name='add', params={'num1': 1, 'num2': 2})
+
+    def _update(self, url, data):
+        return async_to_sync(AsyncClient().post)(url, {'deviceId': 'device-1', 'data': data},
+                                                 content_type='application/json')
+
+    def test_commands_and_results_round_trip(self):
+        response = self.client.get('/api/devices/device-1/pending-commands/')
+        commands = self.cipher.decrypt(response.data['data'])['commands']
+        self.assertEqual([command['name'] for command in commands], ['add'])
+
+        response = self.client.post(f'/api/commands/{self.command.id}/update/', {
+            'deviceId': 'device-1',
+            'data': self.cipher.encrypt({'status': 'completed', 'result': 3})
+        }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.command.refresh_from_db()
+        self.assertEqual(self.command.status, 'completed')
+
+    def test_tampered_result_is_rejected(self):
+        frame = bytearray(self.cipher.seal({'status': 'completed', 'result': 4}))
+        frame[-1] ^= 1
+        tampered = base64.b64encode(bytes(frame)).decode()
+
+        for url in (f'/api/commands/{self.command.id}/update/', f'/api/async/commands/{self.command.id}/update/'):
+            self.assertEqual(self._update(url, tampered).status_code, 403)
+        self.command.refresh_from_db()
+        self.assertEqual(self.command.status, 'pending')
+
+    def test_cbc_devices_keep_their_channel(self):
+        Device.objects.all().delete()
+        AuthorizationToken.objects.update(is_used=False)
+        device_cache.clear()
+
+        body = self.register()
+
+        self.assertEqual(body['sessionChannel'], 'cbc')
+        command = Command.objects.create(device=Device.objects.get(), name='add', params={'num1': 1, 'num2': 2})
+        response = self.client.get('/api/devices/device-1/pending-commands/')
+        commands = decrypt_with_session_key(response.data['data'], body['sessionKey'])['commands']
+        self.assertEqual([c['id'] for c in commands], [str(command.id)])
+
+
+@override_settings(SERVER_PRIVATE_KEY_PEM=None, SERVER_KEY_IN_MEMORY=True, HEARTBEAT_FLUSH_INTERVAL=0)
+class BinaryFramingTests(DeviceRegistrationMixin, TestCase):
+    """Devices negotiating 'binary' framing send and receive raw session frames"""
+
+    def setUp(self):
+        super().setUp()
+        body = self.register(sessionChannels=['gcm'], framings=['binary', 'json'])
+        self.assertEqual(body['framing'], 'binary')
+        self.cipher = GcmSessionCipher(body['sessionKey'])
+        self.command = Command.objects.create(device=Device.objects.get(), name='add', params={'num1': 1, 'num2': 2})
+
+    def _post_frame(self, url, frame):
+        return self.client.generic('POST', url, frame, content_type='application/octet-stream',
+                                   headers={'X-Device-Id': 'device-1'})
+
+    def test_commands_and_results_round_trip(self):
+        response = self.client.get('/api/devices/device-1/pending-commands/',
+                                   headers={'Accept': 'application/octet-stream'})
+
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        commands = self.cipher.open(response.content)['commands']
+        self.assertEqual([command['id'] for command in commands], [str(self.command.id)])
+
+        response = self._post_frame(f'/api/commands/{self.command.id}/update/',
+                                    self.cipher.seal({'status': 'completed', 'result': 3}))
+
+        self.assertEqual(response.status_code, 200)
+        self.command.refresh_from_db()
+        self.assertEqual(self.command.result, {'status': 'completed', 'result': 3})
+
+    def test_truncated_frames_are_rejected(self):
+        frame = self.cipher.seal({'status': 'completed', 'result': 3})[:10]
+
+        self.assertEqual(self._post_frame(f'/api/commands/{self.command.id}/update/', frame).status_code, 403)
+        self.assertEqual(self._post_frame('/api/devices/device-1/heartbeat/', frame).status_code, 403)
+        response = async_to_sync(AsyncClient().post)(
+            f'/api/async/commands/{self.command.id}/update/', frame,
+            content_type='application/octet-stream', headers={'X-Device-Id': 'device-1'}
+        )
+        self.assertEqual(response.status_code, 403)
+        self.command.refresh_from_db()
+        self.assertEqual(self.command.status, 'pending')
+
+
+@override_settings(HEARTBEAT_FLUSH_INTERVAL=5)
+class HeartbeatBufferTests(TestCase):
+    """Heartbeats are coalesced per device and written in one bulk update"""
+
+    def setUp(self):
+        self.buffer = HeartbeatBuffer()
+        # Stand in for the flusher thread, so flushes happen only when the test asks
+        patcher = mock.patch.object(self.buffer, '_start_flusher',
+                                    side_effect=lambda: setattr(self.buffer, '_flusher', mock.Mock()))
+        self.start_flusher = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.devices = [create_device(f'device-{i}') for i in range(3)]
+        Device.objects.update(last_seen=timezone.now() - timedelta(hours=1))
+
+    def test_heartbeats_are_held_until_flushed(self):
+        for _ in range(5):
+            for device in self.devices:
+                self.buffer.record(device.pk)
+        self.assertEqual(self.start_flusher.call_count, 1)
+        self.assertEqual(Device.objects.filter(last_seen__gte=timezone.now() - timedelta(minutes=1)).count(), 0)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.buffer.flush(), 3)
+
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(Device.objects.filter(last_seen__gte=timezone.now() - timedelta(minutes=1)).count(), 3)
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_failed_flush_keeps_newer_heartbeats(self):
+        self.buffer.record(self.devices[0].pk)
+        self.buffer.record(self.devices[1].pk)
+
+        def heartbeat_during_flush(*args, **kwargs):
+            self.buffer.record(self.devices[0].pk)
+            raise RuntimeError('database unavailable')
+
+        newer = self.buffer._pending[self.devices[0].pk]
+        with mock.patch.object(Device.objects, 'bulk_update', side_effect=heartbeat_during_flush):
+            with self.assertRaises(RuntimeError):
+                self.buffer.flush()
+
+        self.assertGreaterEqual(self.buffer._pending[self.devices[0].pk], newer)
+        self.assertEqual(self.buffer.flush(), 2)
+
+    @override_settings(HEARTBEAT_FLUSH_INTERVAL=0)
+    def test_zero_interval_writes_immediately(self):
+        self.buffer.record(self.devices[0].pk)
+
+        self.start_flusher.assert_not_called()
+        self.assertEqual(Device.objects.filter(last_seen__gte=timezone.now() - timedelta(minutes=1)).count(), 1)
+
+
+@override_settings(SERVER_PRIVATE_KEY_PEM=None, SERVER_KEY_IN_MEMORY=True)
+class ServerKeyCachingTests(TestCase):
+    """Devices revalidate the server key with If-None-Match instead of downloading it again"""
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_unchanged_key_is_answered_with_304(self):
+        response = self.client.get('/api/server-key/')
+        etag = response['ETag']
+
+        self.assertEqual(response.data['publicKey'], get_server_public_key_pem())
+        self.assertIn('max-age=', response['Cache-Control'])
+        self.assertEqual(self.client.get('/api/server-key/')['ETag'], etag)
+
+        response = self.client.get('/api/server-key/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+    def test_new_key_is_served_again(self):
+        etag = self.client.get('/api/server-key/')['ETag']
+
+        # Reapplying the key settings drops the cached key, as a key rotation would
+        with override_settings(SERVER_KEY_IN_MEMORY=True):
+            response = self.client.get('/api/server-key/', headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
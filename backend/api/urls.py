@@ -1,6 +1,6 @@
 from django.urls import path
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
-from . import views
+from . import views, async_views
 
 urlpatterns = [
     path('me/', views.me, name='me'),
@@ -27,6 +27,9 @@ urlpatterns = [
     path('devices/<str:device_id>/commands/', views.get_device_commands, name='get_device_commands'),
     path('actions/<str:action_name>/parameters/', views.get_action_parameters, name='get_action_parameters'),
     path('execute-command/', views.execute_command, name='execute_command'),
+    path('commands/batch/', views.execute_command_batch, name='execute_command_batch'),
+    path('jobs/<uuid:job_id>/', views.get_job, name='get_job'),
+    path('jobs/<uuid:job_id>/results/', views.export_job_results, name='export_job_results'),
     path('commands/<uuid:command_id>/status/', views.get_command_status, name='get_command_status'),
 
     # Alternative paths (looks like your URLs have some duplicates)
@@ -47,4 +50,15 @@ urlpatterns = [
 path('devices/<str:device_id>/heartbeat/', views.device_heartbeat, name='device_heartbeat'),
 # Add to your urlpatterns in urls.py
 path('devices/all/', views.get_all_devices, name='get_all_devices'),
+
+    # Async endpoints for ASGI deployments
+    path('async/events/', async_views.dashboard_events, name='async_dashboard_events'),
+    path('async/register-device/', async_views.register_device, name='async_register_device'),
+    path('async/reconnect-device/', async_views.reconnect_device, name='async_reconnect_device'),
+    path('async/devices/<str:device_id>/heartbeat/', async_views.device_heartbeat, name='async_device_heartbeat'),
+    path('async/devices/<str:device_id>/pending-commands/', async_views.get_pending_commands,
+         name='async_get_pending_commands'),
+    path('async/devices/<str:device_id>/stream/', async_views.command_stream, name='async_command_stream'),
+    path('async/commands/<uuid:command_id>/update/', async_views.update_command_status,
+         name='async_update_command_status'),
 ]
\ No newline at end of file
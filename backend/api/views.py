@@ -1,5 +1,4 @@
-from django.core.management import call_command
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from .forms import SignupForm
 from rest_framework.permissions import AllowAny
@@ -47,50 +46,167 @@ def register(request):
             'errors': errors
         })
 import json
+import math
+import time
 import uuid
 import logging
-from datetime import timedelta
+from datetime import timedelta, timezone as dt_timezone
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import Count, Max, Q
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.shortcuts import get_object_or_404
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework import status
 
-from .models import Device, AuthorizationToken, Command, ActionParameter
+from .models import Device, AuthorizationToken, Command, ActionParameter, Job
 from .crypto import (
     decrypt_with_private_key,
     encrypt_with_public_key,
-    get_server_public_key_pem, encrypt_with_session_key, decrypt_with_session_key
+    get_server_public_key_pem, get_server_public_key_etag,
+    SESSION_CHANNEL_CBC, SESSION_CHANNEL_GCM
 )
+from .device_cache import device_cache
+from .delta import SinceExpired, changed_since, deleted_since, listing_etag, next_since, parse_since, removed_since
+from .dispatch import command_notifier
+from .events import publish_command, publish_commands, publish_command_status, publish_device_status
+from .framing import (
+    BinaryFrameRenderer, FRAMING_BINARY, FRAMING_JSON, DEVICE_ID_HEADER,
+    is_binary_request, wants_binary_response, binary_response
+)
+from .heartbeats import heartbeat_buffer
+from .pagination import InvalidCursor, paginate_keyset
+from .scheduler import capability_index, least_loaded_device
 
 logger = logging.getLogger(__name__)
 
 
+# Query parameters narrowing the command and device listings
+COMMAND_FILTERS = ('status', 'name', 'device', 'job')
+DEVICE_FILTERS = ('status', 'name', 'device')
+
+
+def _is_filtered(request, filters):
+    return any(request.query_params.get(name) for name in filters)
+
+
+def _filter_commands(queryset, request):
+    """Apply the ?status=, ?name=, ?device= and ?job= command listing filters"""
+    params = request.query_params
+    if params.get('status'):
+        queryset = queryset.filter(status=params['status'])
+    if params.get('name'):
+        queryset = queryset.filter(name=params['name'])
+    if params.get('device'):
+        queryset = queryset.filter(device__device_id=params['device'])
+    if params.get('job'):
+        try:
+            queryset = queryset.filter(job_id=uuid.UUID(params['job']))
+        except ValueError:
+            queryset = queryset.none()
+    return queryset
+
+
+def _filter_devices(queryset, request):
+    """Apply the ?status=active|inactive, ?name= (device type) and ?device= device listing filters"""
+    params = request.query_params
+    if params.get('status') == 'active':
+        queryset = queryset.online()
+    elif params.get('status') == 'inactive':
+        queryset = queryset.offline()
+    if params.get('name'):
+        queryset = queryset.filter(device_type=params['name'])
+    if params.get('device'):
+        queryset = queryset.filter(device_id=params['device'])
+    return queryset
+
+
+def _serialize_command(command):
+    return {
+        'id': str(command.id),
+        'deviceId': command.device.device_id,
+        'deviceType': command.device.device_type,
+        'name': command.name,
+        'params': command.params,
+        'status': command.status,
+        'result': command.result,
+        'priority': command.priority,
+        'deadline': command.deadline.isoformat() if command.deadline else None,
+        'createdAt': command.created_at.isoformat(),
+        'updatedAt': command.updated_at.isoformat()
+    }
+
+
+def _serialize_device(device):
+    return {
+        'id': str(device.id),
+        'deviceId': device.device_id,
+        'deviceType': device.device_type,
+        'capabilities': device.capabilities,
+        'lastSeen': device.last_seen.isoformat(),
+        'isActive': device.is_online
+    }
+
+
+def _not_modified(request, etag):
+    """A 304 response if the client already holds the listing with this ETag"""
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return None
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_all_commands(request):
-    """Get command history across all devices"""
-    try:
-        # Fetch commands from all devices, with most recent first
-        commands = Command.objects.all().order_by('-created_at')[:200]  # Limit to most recent 200 commands
-
-        # Prepare data with device information included
-        command_list = []
-        for command in commands:
-            command_list.append({
-                'id': str(command.id),
-                'deviceId': command.device.device_id,
-                'deviceType': command.device.device_type,
-                'name': command.name,
-                'params': command.params,
-                'status': command.status,
-                'result': command.result,
-                'createdAt': command.created_at.isoformat(),
-                'updatedAt': command.updated_at.isoformat()
-            })
+    """Get command history across all devices (one page per request, see paginate_keyset)
 
-        return Response({'commands': command_list})
+    Every response carries a `since` token. Passing it back as ?since=
+    returns only the commands updated after it plus the ids of deleted ones,
+    and with filters also of those that no longer match them (`removed`);
+    unchanged listings are answered with 304 via ETag/If-None-Match.
+    """
+    try:
+        since_token = next_since()
+        since = parse_since(request)
+
+        # Join the device in the same query instead of fetching it per row
+        all_commands = Command.objects.select_related('device')
+        commands = _filter_commands(all_commands, request)
+
+        fingerprint = commands.aggregate(latest=Max('updated_at'), count=Count('id'))
+        etag = listing_etag(request, 'command', fingerprint)
+        not_modified = _not_modified(request, etag)
+        if not_modified:
+            return not_modified
+
+        if since is None:
+            # Fetch commands from all devices, with most recent first
+            commands, next_cursor = paginate_keyset(commands, request, 'created_at', default_limit=200)
+            body = {'commands': [_serialize_command(command) for command in commands], 'nextCursor': next_cursor}
+        else:
+            changed = Q(updated_at__gt=since)
+            body = {
+                'commands': [
+                    _serialize_command(command)
+                    for command in changed_since(commands.order_by('updated_at'), changed)
+                ],
+                'deleted': deleted_since('command', since)
+            }
+            if _is_filtered(request, COMMAND_FILTERS):
+                body['removed'] = removed_since(all_commands, commands, changed)
+
+        body['since'] = since_token
+        return Response(body, headers={'ETag': etag})
+    except InvalidCursor as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except SinceExpired as e:
+        return Response({'error': str(e), 'reload': True}, status=status.HTTP_410_GONE)
     except Exception as e:
         logger.error(f"Error retrieving command history: {str(e)}")
         return Response(
@@ -101,22 +217,58 @@ def get_all_commands(request):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_all_devices(request):
-    call_command('mark_inactive_devices', timeout=60)
-    """API to get list of all devices (both active and inactive)"""
-    devices = Device.objects.all()
-    device_list = []
+    """API to get list of all devices (both active and inactive)
 
-    for device in devices:
-        device_list.append({
-            'id': str(device.id),
-            'deviceId': device.device_id,
-            'deviceType': device.device_type,
-            'capabilities': device.capabilities,
-            'lastSeen': device.last_seen.isoformat(),
-            'isActive': device.is_active
-        })
+    Liveness is derived from last_seen when DEVICE_LIVENESS_MODE is 'computed';
+    otherwise `manage.py mark_inactive_devices --loop` keeps is_active up to
+    date. Either way this view only reads. ?since= returns only the devices
+    changed or seen after the token, as in get_all_commands; `deleted` and
+    `removed` list device ids.
+    """
+    try:
+        since_token = next_since()
+        since = parse_since(request)
+        all_devices = Device.objects.with_liveness()
+        devices = _filter_devices(all_devices, request)
+
+        computed = settings.DEVICE_LIVENESS_MODE == 'computed'
+        fingerprint = devices.aggregate(
+            updated=Max('updated_at'),
+            seen=Max('last_seen'),
+            count=Count('id'),
+            # Computed liveness changes with time alone, without touching any row
+            **({'online': Count('id', filter=devices._online_q())} if computed else {})
+        )
+        etag = listing_etag(request, 'device', fingerprint)
+        not_modified = _not_modified(request, etag)
+        if not_modified:
+            return not_modified
+
+        if since is None:
+            devices, next_cursor = paginate_keyset(devices, request, 'registered_at')
+            body = {'devices': [_serialize_device(device) for device in devices], 'nextCursor': next_cursor}
+        else:
+            seen_after = since
+            if computed:
+                # Also report devices that went offline by timing out since then
+                seen_after = since - timedelta(seconds=settings.DEVICE_INACTIVE_TIMEOUT)
+            changed = Q(updated_at__gt=since) | Q(last_seen__gt=seen_after)
+            body = {
+                'devices': [
+                    _serialize_device(device)
+                    for device in changed_since(devices.order_by('updated_at'), changed)
+                ],
+                'deleted': deleted_since('device', since)
+            }
+            if _is_filtered(request, DEVICE_FILTERS):
+                body['removed'] = removed_since(all_devices, devices, changed, field='device_id')
+    except InvalidCursor as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except SinceExpired as e:
+        return Response({'error': str(e), 'reload': True}, status=status.HTTP_410_GONE)
 
-    return Response({'devices': device_list})
+    body['since'] = since_token
+    return Response(body, headers={'ETag': etag})
 
 
 @api_view(['POST'])
@@ -124,30 +276,33 @@ def get_all_devices(request):
 def device_heartbeat(request, device_id):
     """Update the device's last_seen timestamp (heartbeat mechanism)"""
     try:
-        try:
-            device = Device.objects.get(device_id=device_id)
-        except Device.DoesNotExist:
+        device = device_cache.get(device_id)
+        if device is None:
             return Response({'error': 'Device not found'}, status=status.HTTP_404_NOT_FOUND)
 
         # Verify the device identity (optional - can use session key or other method)
-        data = json.loads(request.body)
-        if 'data' in data:
+        if is_binary_request(request):
+            frame, encrypted_data = request.body, None
+        else:
+            frame, encrypted_data = None, json.loads(request.body).get('data')
+        if frame or encrypted_data:
             try:
-                encrypted_data = data.get('data')
-                decrypt_with_session_key(encrypted_data, device.session_key)
                 # Just verifying encryption works, not using the data
+                device, _ = device_cache.decrypt(device, frame, encrypted_data)
             except Exception as e:
                 logger.warning(f"Error decrypting heartbeat data: {str(e)}")
                 return Response({'error': 'Authentication failed'}, status=status.HTTP_403_FORBIDDEN)
 
-        # If previously inactive, reactivate the device
-        was_inactive = not device.is_active
-        if was_inactive:
-            device.is_active = True
+        # If previously inactive, reactivate the device right away
+        if not device.is_active:
+            now = timezone.now()
+            Device.objects.filter(pk=device.pk).update(is_active=True, last_seen=now, updated_at=now)
+            device_cache.invalidate(device_id)
+            publish_device_status(device_id, True, now)
             logger.info(f"Device reactivated via heartbeat: {device_id}")
-
-        # Save the device to update the last_seen timestamp (auto_now field)
-        device.save()
+        else:
+            # Only last_seen changes: let the buffer write it in bulk
+            heartbeat_buffer.record(device.pk)
 
         return Response({'status': 'ok', 'active': True})
     except Exception as e:
@@ -155,6 +310,42 @@ def device_heartbeat(request, device_id):
         return Response({'error': 'Heartbeat failed'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def _negotiate_session_channel(offered, hybrid):
+    """
+    Pick the session channel for a (re)connecting device.
+
+    AES-GCM is used when the device offers it and accepted the hybrid
+    envelope, which has room to announce the choice; otherwise the original
+    CBC channel is kept.
+    """
+    if hybrid and SESSION_CHANNEL_GCM in (offered or []):
+        return SESSION_CHANNEL_GCM
+    return SESSION_CHANNEL_CBC
+
+
+def _negotiate_framing(offered, hybrid):
+    """
+    Pick the wire framing for a (re)connecting device.
+
+    Like the session channel, binary framing is only announced through the
+    hybrid envelope; JSON bodies remain accepted from every device.
+    """
+    if hybrid and FRAMING_BINARY in (offered or []):
+        return FRAMING_BINARY
+    return FRAMING_JSON
+
+
+def _action_table(capabilities):
+    """Parameter definitions of the given actions, keyed by action name"""
+    return {
+        action.action_name: {
+            'parameters': action.parameters,
+            'description': action.description
+        }
+        for action in ActionParameter.objects.filter(action_name__in=capabilities)
+    }
+
+
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def reconnect_device(request):
@@ -180,11 +371,15 @@ def reconnect_device(request):
 
         # Generate a new session key
         session_key = uuid.uuid4().hex + uuid.uuid4().hex  # 64 bytes
+        hybrid = data.get('responseEnvelope') == 'hybrid'
 
         # Update device - EXPLICITLY SET TO ACTIVE
         device.session_key = session_key
+        device.session_channel = _negotiate_session_channel(data.get('sessionChannels'), hybrid)
         device.is_active = True  # This line ensures the device is marked as active
-        device.save()
+        device.save(update_fields=['session_key', 'session_channel', 'is_active', 'last_seen', 'updated_at'])
+        device_cache.invalidate(device_id)
+        publish_device_status(device_id, True, device.last_seen)
 
         logger.info(f"Device reconnected and marked active: {device_id}")
 
@@ -195,7 +390,13 @@ def reconnect_device(request):
             'serverTime': timezone.now().isoformat()
         }
 
-        encrypted_response = encrypt_with_public_key(response_data, device.public_key)
+        # Devices that accept the hybrid envelope have no size limit, so send their action table too
+        if hybrid:
+            response_data['sessionChannel'] = device.session_channel
+            response_data['framing'] = _negotiate_framing(data.get('framings'), hybrid)
+            response_data['actions'] = _action_table(device.capabilities)
+
+        encrypted_response = encrypt_with_public_key(response_data, device.public_key, hybrid=hybrid)
 
         return Response(encrypted_response, status=status.HTTP_200_OK)
 
@@ -242,24 +443,24 @@ def deregister_device(request, device_id):
         data = json.loads(request.body)
 
         # Validate the device
-        try:
-            device = Device.objects.get(device_id=device_id, is_active=True)
-        except Device.DoesNotExist:
+        device = device_cache.get_active(device_id)
+        if device is None:
             return Response({'error': 'Device not found'}, status=status.HTTP_404_NOT_FOUND)
 
         # Optional: Verify encrypted data using session key
         if 'data' in data:
             try:
                 encrypted_data = data.get('data')
-                decrypted_data = decrypt_with_session_key(encrypted_data, device.session_key)
+                decrypted_data = device.cipher.decrypt(encrypted_data)
                 # You could verify the decrypted data here if needed
             except Exception as e:
                 logger.warning(f"Error decrypting deregistration data: {str(e)}")
                 # Continue anyway - we still want to deregister
 
         # Mark the device as inactive
-        device.is_active = False
-        device.save()
+        Device.objects.filter(pk=device.pk).update(is_active=False, updated_at=timezone.now())
+        device_cache.invalidate(device_id)
+        publish_device_status(device_id, False)
 
         logger.info(f"Device deregistered: {device_id}")
         return Response({'status': 'Device deregistered'})
@@ -338,7 +539,10 @@ def register_device(request):
         logger.info("encrypted data received")
 
         # Decrypt the registration data
-        registration_data = decrypt_with_private_key(encrypted_data)
+        try:
+            registration_data = decrypt_with_private_key(encrypted_data)
+        except Exception:
+            return Response({'error': 'Invalid encrypted data'}, status=status.HTTP_400_BAD_REQUEST)
 
         # Extract device information
         device_info = registration_data.get('deviceInfo', {})
@@ -360,6 +564,8 @@ def register_device(request):
 
         # Generate a session key
         session_key = uuid.uuid4().hex + uuid.uuid4().hex  # 64 bytes (32 hex chars * 2)
+        hybrid = registration_data.get('responseEnvelope') == 'hybrid'
+        session_channel = _negotiate_session_channel(registration_data.get('sessionChannels'), hybrid)
 
         # Create the device record
         device, created = Device.objects.update_or_create(
@@ -367,17 +573,21 @@ def register_device(request):
             defaults={
                 'public_key': public_key,
                 'session_key': session_key,
+                'session_channel': session_channel,
                 'device_type': metadata.get('type', 'unknown'),
                 'capabilities': capabilities,
                 'metadata': metadata,
                 'is_active': True
             }
         )
+        device_cache.invalidate(device_id)
+        capability_index.add(device.pk, capabilities)
+        publish_device_status(device_id, True, device.last_seen)
         logger.info("device created")
         # Mark the token as used if this is a new device
         if created:
             token.is_used = True
-            token.save()
+            token.save(update_fields=['is_used'])
 
         # Prepare response
         response_data = {
@@ -386,8 +596,14 @@ def register_device(request):
             'serverTime': timezone.now().isoformat()
         }
 
+        # Devices that accept the hybrid envelope have no size limit, so send their action table too
+        if hybrid:
+            response_data['sessionChannel'] = session_channel
+            response_data['framing'] = _negotiate_framing(registration_data.get('framings'), hybrid)
+            response_data['actions'] = _action_table(capabilities)
+
         # Encrypt the response with the device's public key
-        encrypted_response = encrypt_with_public_key(response_data, public_key)
+        encrypted_response = encrypt_with_public_key(response_data, public_key, hybrid=hybrid)
 
         logger.info(f"Device registered: {device_id} ({metadata.get('type')})")
         return Response(encrypted_response, status=status.HTTP_200_OK)
@@ -401,7 +617,12 @@ def register_device(request):
 @permission_classes([IsAuthenticated])
 def get_devices(request):
     """API to get list of registered devices"""
-    devices = Device.objects.filter(is_active=True)
+    try:
+        devices, next_cursor = paginate_keyset(
+            _filter_devices(Device.objects.online(), request), request, 'registered_at'
+        )
+    except InvalidCursor as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     device_list = []
 
     for device in devices:
@@ -413,7 +634,7 @@ def get_devices(request):
             'lastSeen': device.last_seen.isoformat()
         })
 
-    return Response({'devices': device_list})
+    return Response({'devices': device_list, 'nextCursor': next_cursor})
 
 
 @api_view(['GET'])
@@ -481,10 +702,61 @@ def get_action_parameters(request, action_name):
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def _command_params_error(command_name, params):
+    """Why `params` cannot be sent with the command, or None when they are valid"""
+    if not isinstance(params, dict):
+        return 'Command parameters must be an object'
+
+    # Validate parameters for code execution commands
+    if command_name == "execute_code":
+        if "code" not in params:
+            return "Missing required parameter 'code'"
+    elif command_name == "execute_code_with_input":
+        if "code" not in params or "input_data" not in params:
+            return "Missing required parameters for execute_code_with_input"
+
+    # Extra security measure: Log all code execution commands
+    if command_name in ["execute_code", "execute_code_with_input"]:
+        logger.debug(f"Code content: {str(params.get('code', ''))[:100]}...")
+    return None
+
+
+def _unsupported_command_error(command_name):
+    return f"Command '{command_name}' not supported by this device"
+
+
+def _command_scheduling(data, priority=0, deadline=None):
+    """
+    The optional priority and deadline of a command submission, falling back
+    to the given defaults. Raises ValueError with the reason when invalid.
+    """
+    if 'priority' in data:
+        priority = data['priority']
+        if isinstance(priority, bool) or not isinstance(priority, int) or not -32768 <= priority <= 32767:
+            raise ValueError('priority must be an integer between -32768 and 32767')
+
+    if data.get('deadline'):
+        deadline = parse_datetime(str(data['deadline']))
+        if deadline is None:
+            raise ValueError('deadline must be an ISO 8601 date and time')
+        if timezone.is_naive(deadline):
+            deadline = timezone.make_aware(deadline, dt_timezone.utc)
+        if deadline <= timezone.now():
+            raise ValueError('deadline is in the past')
+    return priority, deadline
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def execute_command(request):
-    """Execute a command on a device"""
+    """Execute a command on a device
+
+    Without a deviceId the command is routed to the least-loaded online
+    device supporting it (see scheduler.least_loaded_device), and the
+    response names the device it was assigned to. An optional priority
+    (higher is delivered first) and deadline (ISO 8601, UTC unless given)
+    control when the device receives it.
+    """
     try:
         data = json.loads(request.body)
         device_id = data.get('deviceId')
@@ -492,50 +764,58 @@ def execute_command(request):
         params = data.get('params', {})
 
         # Validate required fields
-        if not device_id or not command_name:
+        if not command_name:
             return Response({'error': 'Missing required fields'}, status=status.HTTP_400_BAD_REQUEST)
 
         # Get the device
-        try:
-            device = Device.objects.get(device_id=device_id, is_active=True)
-        except Device.DoesNotExist:
-            return Response({'error': 'Device not found'}, status=status.HTTP_404_NOT_FOUND)
+        if device_id:
+            try:
+                device = Device.objects.online().get(device_id=device_id)
+            except Device.DoesNotExist:
+                return Response({'error': 'Device not found'}, status=status.HTTP_404_NOT_FOUND)
+        else:
+            device = least_loaded_device(command_name)
+            if device is None:
+                return Response({
+                    'error': f"No online device supports command '{command_name}'"
+                }, status=status.HTTP_404_NOT_FOUND)
+            device_id = device.device_id
 
         # Validate the command is supported by the device
         if command_name not in device.capabilities:
             return Response({
-                'error': f"Command '{command_name}' not supported by this device"
+                'error': _unsupported_command_error(command_name)
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        # Validate parameters for code execution commands
-        if command_name == "execute_code":
-            if "code" not in params:
-                return Response({
-                    'error': "Missing required parameter 'code'"
-                }, status=status.HTTP_400_BAD_REQUEST)
-        elif command_name == "execute_code_with_input":
-            if "code" not in params or "input_data" not in params:
-                return Response({
-                    'error': "Missing required parameters for execute_code_with_input"
-                }, status=status.HTTP_400_BAD_REQUEST)
+        params_error = _command_params_error(command_name, params)
+        if params_error:
+            return Response({'error': params_error}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Extra security measure: Log all code execution commands
-        if command_name in ["execute_code", "execute_code_with_input"]:
-            logger.debug(f"Code content: {params.get('code', '')[:100]}...")
+        try:
+            priority, deadline = _command_scheduling(data)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         # Create the command
         command = Command.objects.create(
             device=device,
             name=command_name,
             params=params,
-            status='pending'
+            status='pending',
+            priority=priority,
+            deadline=deadline
         )
 
+        # Wake up the device if it is parked in a long poll, and tell open dashboards
+        transaction.on_commit(lambda: command_notifier.notify(device.pk))
+        transaction.on_commit(lambda: publish_command(command, device.device_id, device.device_type))
+
         logger.info(f"Command {command_name} created for device {device_id}")
 
         return Response({
             'status': 'Command queued',
-            'commandId': str(command.id)
+            'commandId': str(command.id),
+            'deviceId': device_id
         })
 
     except Exception as e:
@@ -543,12 +823,278 @@ def execute_command(request):
         return Response({'error': 'Error processing command'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def _batch_from_list(entries, priority, deadline):
+    """
+    Commands for an explicit list of {deviceId, command, params} entries,
+    each optionally overriding the batch's priority and deadline.
+
+    Returns (commands, errors): all target devices are fetched in one query,
+    and any invalid entry is reported by index so the batch can be rejected whole.
+    """
+    device_ids = {
+        entry['deviceId'] for entry in entries
+        if isinstance(entry, dict) and isinstance(entry.get('deviceId'), str)
+    }
+    devices = {
+        device.device_id: device
+        for device in Device.objects.online()
+        .filter(device_id__in=device_ids)
+        .only('id', 'device_id', 'device_type', 'capabilities')
+    }
+
+    commands, errors = [], []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get('deviceId') or not entry.get('command'):
+            errors.append({'index': index, 'error': 'Missing required fields'})
+            continue
+        if not isinstance(entry['deviceId'], str) or not isinstance(entry['command'], str):
+            errors.append({'index': index, 'error': 'deviceId and command must be strings'})
+            continue
+
+        device = devices.get(entry['deviceId'])
+        command_name = entry['command']
+        params = entry.get('params', {})
+        if device is None:
+            error = 'Device not found'
+        elif command_name not in device.capabilities:
+            error = _unsupported_command_error(command_name)
+        else:
+            error = _command_params_error(command_name, params)
+
+        if not error:
+            try:
+                entry_priority, entry_deadline = _command_scheduling(entry, priority, deadline)
+            except ValueError as e:
+                error = str(e)
+
+        if error:
+            errors.append({'index': index, 'deviceId': entry['deviceId'], 'error': error})
+        else:
+            commands.append(Command(
+                device=device,
+                name=command_name,
+                params=params,
+                priority=entry_priority,
+                deadline=entry_deadline
+            ))
+    return commands, errors
+
+
+def _batch_from_selector(command_name, params, selector, priority, deadline):
+    """
+    Commands fanning one command out to the online devices matching `selector`.
+
+    Returns (commands, skipped), skipped being the matching devices that do
+    not support the command. Capabilities are a JSON list, checked in Python
+    over the single device query.
+    """
+    devices = Device.objects.online().only('id', 'device_id', 'device_type', 'capabilities')
+    if selector.get('deviceType'):
+        devices = devices.filter(device_type=selector['deviceType'])
+    capability = selector.get('capability')
+
+    commands, skipped = [], 0
+    for device in devices:
+        if capability and capability not in device.capabilities:
+            continue
+        if command_name not in device.capabilities:
+            skipped += 1
+            continue
+        commands.append(Command(device=device, name=command_name, params=params, priority=priority, deadline=deadline))
+    return commands, skipped
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def execute_command_batch(request):
+    """Queue many commands in one request
+
+    The body is either an explicit list,
+        {"commands": [{"deviceId": ..., "command": ..., "params": {...}}, ...]}
+    which is rejected whole when any entry is invalid, or one command fanned
+    out to the online devices picked by a selector,
+        {"command": ..., "params": {...}, "selector": {"deviceType": ..., "capability": ...}}
+    where {"all": true} selects every online device. A top-level priority
+    and deadline apply to every command, as in execute_command. Devices are
+    validated in one query and the commands inserted with bulk_create under
+    a new Job, whose progress is read from /api/jobs/<jobId>/.
+    """
+    try:
+        data = request.data
+        skipped = None
+
+        try:
+            priority, deadline = _command_scheduling(data)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if 'commands' in data:
+            entries = data['commands']
+            if not isinstance(entries, list) or not entries:
+                return Response({'error': 'commands must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+            if len(entries) > settings.COMMAND_SUBMIT_MAX_BATCH_SIZE:
+                return Response({
+                    'error': f'A batch holds at most {settings.COMMAND_SUBMIT_MAX_BATCH_SIZE} commands'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            commands, errors = _batch_from_list(entries, priority, deadline)
+            if errors:
+                return Response({'error': 'Invalid commands in batch', 'errors': errors},
+                                status=status.HTTP_400_BAD_REQUEST)
+        else:
+            command_name = data.get('command')
+            params = data.get('params', {})
+            selector = data.get('selector')
+            if not command_name or not isinstance(selector, dict):
+                return Response({'error': 'Missing required fields'}, status=status.HTTP_400_BAD_REQUEST)
+            if not isinstance(command_name, str):
+                return Response({'error': 'command must be a string'}, status=status.HTTP_400_BAD_REQUEST)
+            if not (selector.get('deviceType') or selector.get('capability') or selector.get('all') is True):
+                return Response({
+                    'error': 'The selector needs a deviceType, a capability or "all": true'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            params_error = _command_params_error(command_name, params)
+            if params_error:
+                return Response({'error': params_error}, status=status.HTTP_400_BAD_REQUEST)
+
+            commands, skipped = _batch_from_selector(command_name, params, selector, priority, deadline)
+            if not commands:
+                return Response({'error': 'No online device matches the selector', 'skipped': skipped},
+                                status=status.HTTP_404_NOT_FOUND)
+            if len(commands) > settings.COMMAND_SUBMIT_MAX_BATCH_SIZE:
+                return Response({
+                    'error': f'The selector matches {len(commands)} devices; a batch holds at most '
+                             f'{settings.COMMAND_SUBMIT_MAX_BATCH_SIZE} commands'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            job = Job.objects.create(
+                name=data.get('command') or commands[0].name,
+                created_by=request.user.email,
+                total=len(commands),
+                pending=len(commands)
+            )
+            for command in commands:
+                command.job = job
+            Command.objects.bulk_create(commands, batch_size=500)
+
+        # Wake up the target devices parked in a long poll, and tell open dashboards
+        device_keys = {command.device_id for command in commands}
+
+        def notify_devices():
+            for device_key in device_keys:
+                command_notifier.notify(device_key)
+
+        transaction.on_commit(notify_devices)
+        transaction.on_commit(lambda: publish_commands(commands))
+
+        logger.info(f"Job {job.id}: {len(commands)} commands queued for {len(device_keys)} devices")
+
+        body = {'status': 'Commands queued', 'jobId': str(job.id), 'count': len(commands)}
+        if skipped is None:
+            body['commandIds'] = [str(command.id) for command in commands]
+        else:
+            body['skipped'] = skipped
+        return Response(body)
+
+    except Exception as e:
+        logger.error(f"Execute command batch error: {str(e)}")
+        return Response({'error': 'Error processing command batch'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def _serialize_job(job):
+    return {
+        'id': str(job.id),
+        'name': job.name,
+        'createdBy': job.created_by,
+        'total': job.total,
+        'pending': job.pending,
+        'sent': job.sent,
+        'completed': job.completed,
+        'failed': job.failed,
+        'finished': job.is_finished,
+        'createdAt': job.created_at.isoformat(),
+        'updatedAt': job.updated_at.isoformat()
+    }
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_job(request, job_id):
+    """Aggregate progress of a job, read from its counters rather than its commands"""
+    job = get_object_or_404(Job, id=job_id)
+    return Response(_serialize_job(job))
+
+
+def _async_chunks(chunks):
+    """
+    Drive a sync generator of response chunks from the event loop.
+
+    Django's ASGI handler reads a sync iterator completely into memory before
+    sending it. Here each chunk is produced by a thread-sensitive call
+    instead, so the database cursor behind `chunks` stays on one thread.
+    """
+    next_chunk = sync_to_async(next)
+
+    async def iterate():
+        try:
+            while (chunk := await next_chunk(chunks, None)) is not None:
+                yield chunk
+        finally:
+            await sync_to_async(chunks.close)()
+
+    return iterate()
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def export_job_results(request, job_id):
+    """Stream the commands of a job as newline-delimited JSON
+
+    One object per line with the command id, device, status and result,
+    read from the database and sent in chunks so large jobs are never held
+    in memory, under WSGI and ASGI alike. ?status= limits the export to one
+    status.
+    """
+    job = get_object_or_404(Job, id=job_id)
+    commands = job.commands.order_by('created_at', 'id')
+    if request.query_params.get('status'):
+        commands = commands.filter(status=request.query_params['status'])
+    rows = commands.values_list('id', 'device__device_id', 'status', 'result', 'updated_at')
+    chunk_size = 2000
+
+    def chunks():
+        lines = []
+        for command_id, device_id, command_status, result, updated_at in rows.iterator(chunk_size=chunk_size):
+            lines.append(json.dumps({
+                'id': str(command_id),
+                'deviceId': device_id,
+                'status': command_status,
+                'result': result,
+                'updatedAt': updated_at.isoformat()
+            }) + '\n')
+            if len(lines) == chunk_size:
+                yield ''.join(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines)
+
+    content = chunks()
+    if isinstance(request._request, ASGIRequest):
+        content = _async_chunks(content)
+
+    response = StreamingHttpResponse(content, content_type='application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="job-{job.id}.ndjson"'
+    return response
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_command_status(request, command_id):
     """Get the status of a command"""
     try:
-        command = get_object_or_404(Command, id=command_id)
+        command = get_object_or_404(Command.objects.select_related('device'), id=command_id)
 
         return Response({
             'id': str(command.id),
@@ -557,6 +1103,8 @@ def get_command_status(request, command_id):
             'params': command.params,
             'status': command.status,
             'result': command.result,
+            'priority': command.priority,
+            'deadline': command.deadline.isoformat() if command.deadline else None,
             'createdAt': command.created_at.isoformat(),
             'updatedAt': command.updated_at.isoformat()
         })
@@ -568,40 +1116,52 @@ def get_command_status(request, command_id):
 @api_view(['POST'])
 @permission_classes([AllowAny])  # Devices might not have authentication
 def update_command_status(request, command_id):
-    """Update the status and result of a command (called by device)"""
+    """Update the status and result of a command (called by device)
+
+    The body is either JSON ({"deviceId", "data": <base64 frame>}) or, for
+    devices using binary framing, the raw frame with the device id in the
+    X-Device-Id header.
+    """
     try:
-        data = json.loads(request.body)
-        device_id = data.get('deviceId')
-        encrypted_data = data.get('data')
+        if is_binary_request(request):
+            device_id = request.headers.get(DEVICE_ID_HEADER)
+            frame = request.body
+            encrypted_data = None
+        else:
+            data = json.loads(request.body)
+            device_id = data.get('deviceId')
+            encrypted_data = data.get('data')
+            frame = None
 
         # Validate required fields
-        if not device_id or not encrypted_data:
+        if not device_id or not (encrypted_data or frame):
             return Response({'error': 'Missing required fields'}, status=status.HTTP_400_BAD_REQUEST)
 
         # Get the device
-        try:
-            device = Device.objects.get(device_id=device_id, is_active=True)
-        except Device.DoesNotExist:
+        device = device_cache.get_active(device_id)
+        if device is None:
             return Response({'error': 'Device not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        # Get the command
-        try:
-            command = Command.objects.get(id=command_id, device=device)
-        except Command.DoesNotExist:
-            return Response({'error': 'Command not found'}, status=status.HTTP_404_NOT_FOUND)
-
         # Decrypt the result data
-        result_data = decrypt_with_session_key(encrypted_data, device.session_key)
+        try:
+            device, result_data = device_cache.decrypt(device, frame, encrypted_data)
+        except Exception as e:
+            logger.warning(f"Error decrypting command result: {str(e)}")
+            return Response({'error': 'Authentication failed'}, status=status.HTTP_403_FORBIDDEN)
+        if not device.is_active:
+            return Response({'error': 'Device not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        # Update the command
-        command.status = result_data.get('status', 'completed')
-        command.result = result_data
-        command.save()
+        # Update the command in place, writing only the columns that change
+        command_status = result_data.get('status', 'completed')
+        now = Command.objects.record_result(command_id, device.pk, command_status, result_data)
+        if now is None:
+            return Response({'error': 'Command not found'}, status=status.HTTP_404_NOT_FOUND)
+        publish_command_status(command_id, command_status, now, result_data)
 
         # Update device's last_seen timestamp
-        device.save()  # This will update the auto_now field
+        heartbeat_buffer.record(device.pk)
 
-        logger.info(f"Command {command_id} updated to {command.status}")
+        logger.info(f"Command {command_id} updated to {command_status}")
 
         return Response({'status': 'Command updated'})
     except Exception as e:
@@ -612,24 +1172,20 @@ def update_command_status(request, command_id):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_device_commands(request, device_id):
-    """Get all commands for a specific device"""
+    """Get all commands for a specific online device, shaped like the command history"""
     try:
-        device = get_object_or_404(Device, device_id=device_id, is_active=True)
-        commands = Command.objects.filter(device=device).order_by('-created_at')[:100]
-
-        command_list = []
-        for command in commands:
-            command_list.append({
-                'id': str(command.id),
-                'name': command.name,
-                'params': command.params,
-                'status': command.status,
-                'result': command.result,
-                'createdAt': command.created_at.isoformat(),
-                'updatedAt': command.updated_at.isoformat()
-            })
+        device = get_object_or_404(Device.objects.online(), device_id=device_id)
+        commands, next_cursor = paginate_keyset(
+            _filter_commands(Command.objects.select_related('device').filter(device=device), request),
+            request, 'created_at', default_limit=100
+        )
 
-        return Response({'commands': command_list})
+        return Response({
+            'commands': [_serialize_command(command) for command in commands],
+            'nextCursor': next_cursor
+        })
+    except InvalidCursor as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         logger.error(f"Error getting device commands: {str(e)}")
         return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
@@ -638,42 +1194,102 @@ def get_device_commands(request, device_id):
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def get_server_public_key(request):
-    """Return the server's public key"""
+    """Return the server's public key
+
+    The response carries an ETag so devices can revalidate with If-None-Match
+    and get a 304 instead of downloading the key again.
+    """
     try:
+        etag = get_server_public_key_etag()
+        headers = {
+            'ETag': etag,
+            'Cache-Control': f'public, max-age={settings.SERVER_KEY_MAX_AGE}'
+        }
+
+        if etag in request.headers.get('If-None-Match', ''):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
         return Response({
             'publicKey': get_server_public_key_pem()
-        })
+        }, headers=headers)
     except Exception as e:
         logger.error(f"Error getting server public key: {str(e)}")
         return Response({'error': 'Error retrieving public key'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def _parse_poll_args(query):
+    """
+    The clamped (wait, limit) of a pending-commands poll. Raises ValueError
+    for values that are not numbers, including nan and inf, which would
+    otherwise keep the poll loop spinning.
+    """
+    wait = float(query.get('wait', 0))
+    limit = int(query.get('limit', settings.COMMAND_CLAIM_BATCH_SIZE))
+    if not math.isfinite(wait):
+        raise ValueError(f'Invalid wait value: {wait}')
+    wait = min(max(wait, 0), settings.COMMAND_LONG_POLL_MAX_WAIT)
+    limit = min(max(limit, 1), settings.COMMAND_CLAIM_MAX_BATCH_SIZE)
+    return wait, limit
+
+
+def _take_pending_commands(device_pk, limit):
+    """Claim a batch of the device's pending commands and mark them as sent"""
+    command_list = [
+        {
+            'id': str(command['id']),
+            'name': command['name'],
+            'params': command['params']
+        }
+        for command in Command.objects.claim_pending(device_pk, limit)
+    ]
+
+    now = timezone.now()
+    for command in command_list:
+        publish_command_status(command['id'], 'sent', now)
+    return command_list
+
+
 @api_view(['GET'])
 @permission_classes([AllowAny])  # Devices may not have authentication
+@renderer_classes(api_settings.DEFAULT_RENDERER_CLASSES + [BinaryFrameRenderer])
 def get_pending_commands(request, device_id):
-    """Get pending commands for a device (called by device)"""
+    """Get pending commands for a device (called by device)
+
+    With ?wait=<seconds> the request is held open until a command is queued
+    for the device or the timeout expires (long polling). ?limit=<n> bounds
+    how many commands are claimed per poll. Devices sending
+    `Accept: application/octet-stream` get the raw encrypted frame as the
+    body, with the wait echoed in the X-Long-Poll-Wait header.
+    """
     try:
+        try:
+            wait, limit = _parse_poll_args(request.query_params)
+        except ValueError:
+            return Response({'error': 'Invalid wait or limit value'}, status=status.HTTP_400_BAD_REQUEST)
+
         # Get the device
-        device = get_object_or_404(Device, device_id=device_id, is_active=True)
+        device = device_cache.get_active(device_id)
+        if device is None:
+            return Response({'error': 'Device not found'}, status=status.HTTP_404_NOT_FOUND)
 
         # Update last_seen timestamp
-        device.save()  # This will update the auto_now field
-
-        # Get pending commands
-        pending_commands = Command.objects.filter(device=device, status='pending')
-
-        command_list = []
-        for command in pending_commands:
-            # Mark as sent
-            command.status = 'sent'
-            command.save()
-
-            # Add to response
-            command_list.append({
-                'id': str(command.id),
-                'name': command.name,
-                'params': command.params
-            })
+        heartbeat_buffer.record(device.pk)
+
+        # Listen before the first query so a command created in between still wakes us up
+        with command_notifier.listen(device.pk) as command_queued:
+            command_list = _take_pending_commands(device.pk, limit)
+
+            deadline = time.monotonic() + wait
+            while not command_list:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                # Commands queued by another server process don't notify us,
+                # so re-check the database periodically as well
+                command_queued.wait(min(remaining, settings.COMMAND_LONG_POLL_RECHECK_INTERVAL))
+                command_queued.clear()
+                command_list = _take_pending_commands(device.pk, limit)
 
         # Encrypt the response if the device has a session key
         if device.session_key:
@@ -681,12 +1297,15 @@ def get_pending_commands(request, device_id):
                 'commands': command_list,
                 'timestamp': timezone.now().isoformat()
             }
-            encrypted_data = encrypt_with_session_key(command_data, device.session_key)
-            return Response({'data': encrypted_data}, status=status.HTTP_200_OK)
+            if wants_binary_response(request):
+                return binary_response(device.cipher.seal(command_data), headers={'X-Long-Poll-Wait': str(wait)})
+
+            encrypted_data = device.cipher.encrypt(command_data)
+            return Response({'data': encrypted_data, 'wait': wait}, status=status.HTTP_200_OK)
         else:
             # Fallback for devices without session key (shouldn't happen in normal operation)
-            return Response({'commands': command_list}, status=status.HTTP_200_OK)
+            return Response({'commands': command_list, 'wait': wait}, status=status.HTTP_200_OK)
 
     except Exception as e:
         logger.error(f"Error getting pending commands: {str(e)}")
-        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
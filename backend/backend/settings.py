@@ -144,3 +144,94 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Device command dispatch
+
+# Longest time (seconds) a device may park a pending-commands request with ?wait=
+COMMAND_LONG_POLL_MAX_WAIT = 60
+
+# How often (seconds) a parked long poll re-checks the database, so commands
+# queued by another server process are still picked up
+COMMAND_LONG_POLL_RECHECK_INTERVAL = 5
+
+# Seconds a device's X-Device-Auth proof stays valid when opening its command stream
+COMMAND_STREAM_AUTH_MAX_AGE = 60
+
+# Seconds between keepalive comments on an idle dashboard event stream
+DASHBOARD_EVENTS_KEEPALIVE = 15
+
+# Number of pending commands a device claims per poll (?limit=), and the upper bound
+COMMAND_CLAIM_BATCH_SIZE = 50
+COMMAND_CLAIM_MAX_BATCH_SIZE = 500
+
+# Seconds a device has to report a claimed command before its lease expires
+# and `manage.py reap_expired_leases` hands the command out again
+COMMAND_LEASE_DURATION = 300
+# Deliveries per command before an expired lease fails it instead
+COMMAND_MAX_ATTEMPTS = 3
+# Seconds between runs of `manage.py reap_expired_leases --loop`, which has to
+# run next to the server for expired leases to be handed out again
+COMMAND_REAP_INTERVAL = 30
+
+# Most commands one batch submission (/api/commands/batch/) may queue
+COMMAND_SUBMIT_MAX_BATCH_SIZE = 10000
+
+# Seconds between rebuilds of the capability -> device index used to route
+# commands submitted without a deviceId; registrations in the same process
+# update it immediately
+SCHEDULER_INDEX_TTL = 30
+
+# Default and maximum page size (?limit=) of the cursor-paginated listings
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# Delta sync (?since=) of the device and command listings
+
+# Seconds the handed-out since token lags behind the read, so rows committed
+# late with earlier timestamps are still included in the next delta
+SYNC_CURSOR_LAG = 2
+# Seconds deletions are remembered; older since tokens get a 410 and a full reload
+SYNC_TOMBSTONE_RETENTION = 7 * 24 * 3600
+
+# Device liveness
+
+# 'computed': online/offline is derived from last_seen at read time and
+# is_active only records explicit deregistration, so no sweep writes happen.
+# 'stored': is_active is flipped by sweeps, so `manage.py mark_inactive_devices
+# --loop` has to run next to the server or silent devices stay online.
+DEVICE_LIVENESS_MODE = 'computed'
+
+# Seconds without a heartbeat before a device is considered inactive
+DEVICE_INACTIVE_TIMEOUT = 60
+
+# Seconds between sweeps of `manage.py mark_inactive_devices --loop`
+DEVICE_SWEEP_INTERVAL = 15
+
+# Seconds between bulk writes of buffered device last_seen timestamps (0 writes immediately)
+HEARTBEAT_FLUSH_INTERVAL = 5
+HEARTBEAT_FLUSH_BATCH_SIZE = 500
+
+# Device credential cache used by device-originated requests
+DEVICE_CACHE_SIZE = 10000
+# Seconds an entry is trusted before re-reading the device (0 disables caching)
+DEVICE_CACHE_TTL = 30
+# Optional Django cache alias (see CACHES) to share entries between server processes.
+# Set it when running several processes: invalidations then reach all of them at
+# once; without it another process may use a stale active flag for up to the TTL
+DEVICE_CACHE_ALIAS = None
+
+# Server RSA key pair, loaded on first use. A PEM in SERVER_PRIVATE_KEY_PEM
+# takes precedence; otherwise the key is read from SERVER_PRIVATE_KEY_PATH and
+# generated there if missing. SERVER_KEY_IN_MEMORY uses a throwaway key that is
+# never written to disk (for tests).
+SERVER_PRIVATE_KEY_PEM = os.environ.get('SERVER_PRIVATE_KEY_PEM')
+SERVER_PRIVATE_KEY_PATH = os.environ.get('SERVER_PRIVATE_KEY_PATH', BASE_DIR / 'server_private_key.pem')
+SERVER_PUBLIC_KEY_PATH = os.environ.get('SERVER_PUBLIC_KEY_PATH', BASE_DIR / 'server_public_key.pem')
+SERVER_KEY_IN_MEMORY = False
+
+# Seconds devices may cache the /server-key response before revalidating it
+SERVER_KEY_MAX_AGE = 3600
+
+# Worker processes for the server's RSA private-key operations (registration
+# envelopes). 0 runs them inline in the request worker.
+CRYPTO_POOL_WORKERS = int(os.environ.get('CRYPTO_POOL_WORKERS', 0))
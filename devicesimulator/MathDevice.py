@@ -15,6 +15,8 @@ import contextlib
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 # Import our persistence module
 from DevicePersistence import DevicePersistence
@@ -36,6 +38,10 @@ class MathDevice:
         self.server_url = server_url.rstrip('/')
         self.server_public_key = None
 
+        # Last server key we downloaded, reused when the server answers 304
+        self.server_public_key_pem = None
+        self.server_key_etag = None
+
         # Authentication
         self.auth_token = auth_token
 
@@ -49,12 +55,31 @@ class MathDevice:
         self.public_key_pem = None
         self.session_key = None
 
+        # Negotiated session channel ("cbc" or "gcm") and the AES-GCM context built once per session
+        self.session_channel = "cbc"
+        self.session_aead = None
+
+        # Whether the server agreed to raw octet-stream bodies instead of base64-in-JSON
+        self.binary_framing = False
+
         # Try to load existing device info or create new
         if not self._load_device_identity():
             self._create_device_identity()
 
         # Session information
         self.running = False
+        self.action_parameters = {}
+
+        # Long polling: how long the server may hold a pending-commands request,
+        # and whether the server honoured it on the last poll
+        self.long_poll_wait = 15
+        self.long_poll_active = False
+
+        # Push channel: receive commands over the server's event stream, polling
+        # only while it is unavailable, and when to try the stream again
+        self.use_command_stream = True
+        self.stream_retry_at = 0
+        self.last_heartbeat = 0
 
         # Set up supported operations based on device type
         self.operations = self._get_operations()
@@ -72,17 +97,22 @@ class MathDevice:
                 "status": "active"
             }
 
-            # Encrypt the data with the session key
-            encrypted_data = self.encrypt_with_session_key(heartbeat_data)
-
-            # Send the heartbeat
-            response = requests.post(
-                f"{self.server_url}/devices/{self.device_id}/heartbeat/",
-                json={
-                    "deviceId": self.device_id,
-                    "data": encrypted_data
-                }
-            )
+            # Encrypt the data with the session key and send the heartbeat
+            url = f"{self.server_url}/devices/{self.device_id}/heartbeat/"
+            if self.binary_framing:
+                response = requests.post(
+                    url,
+                    data=self.seal_with_session_key(heartbeat_data),
+                    headers={"Content-Type": "application/octet-stream"}
+                )
+            else:
+                response = requests.post(
+                    url,
+                    json={
+                        "deviceId": self.device_id,
+                        "data": self.encrypt_with_session_key(heartbeat_data)
+                    }
+                )
 
             if response.status_code == 200:
                 logger.debug("Heartbeat sent successfully")
@@ -123,6 +153,10 @@ class MathDevice:
                 logger.warning("No private key in saved configuration")
                 return False
 
+            # Cached server key, revalidated with its ETag on first use
+            self.server_public_key_pem = device_info.get('server_public_key')
+            self.server_key_etag = device_info.get('server_key_etag')
+
             logger.info(f"Loaded existing device identity: {self.device_id}")
             return True
 
@@ -153,7 +187,9 @@ class MathDevice:
                 encoding=serialization.Encoding.PEM,
                 format=serialization.PrivateFormat.PKCS8,
                 encryption_algorithm=serialization.NoEncryption()
-            ).decode()
+            ).decode(),
+            'server_public_key': self.server_public_key_pem,
+            'server_key_etag': self.server_key_etag
         }
 
         self.persistence.save_device_info(device_info)
@@ -254,11 +290,25 @@ class MathDevice:
     def get_server_public_key(self):
         """Get the server's public key"""
         try:
-            response = requests.get(f"{self.server_url}/server-key")
-            if response.status_code == 200:
+            headers = {}
+            if self.server_public_key_pem and self.server_key_etag:
+                headers["If-None-Match"] = self.server_key_etag
+
+            response = requests.get(f"{self.server_url}/server-key", headers=headers)
+            if response.status_code == 304:
+                # Our cached copy is still current
+                self.server_public_key = serialization.load_pem_public_key(
+                    self.server_public_key_pem.encode()
+                )
+                logger.info("Server public key unchanged, using cached copy")
+                return True
+            elif response.status_code == 200:
+                self.server_public_key_pem = response.json()["publicKey"]
+                self.server_key_etag = response.headers.get("ETag")
                 self.server_public_key = serialization.load_pem_public_key(
-                    response.json()["publicKey"].encode()
+                    self.server_public_key_pem.encode()
                 )
+                self._save_device_identity()
                 logger.info("Retrieved server public key")
                 return True
             else:
@@ -314,26 +364,66 @@ class MathDevice:
             raise Exception(f"Encryption failed: {str(e)}")
 
     def decrypt_with_private_key(self, encrypted_data):
-        """Decrypt data with our private key"""
-        encrypted_bytes = base64.b64decode(encrypted_data)
-
-        # RSA decryption with OAEP padding
-        decrypted = self.private_key.decrypt(
-            encrypted_bytes,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
+        """Decrypt data with our private key
+
+        Accepts either a base64 RSA-OAEP blob, or the hybrid envelope
+        (RSA-wrapped AES-GCM key, nonce and ciphertext) sent to devices
+        that asked for it.
+        """
+        oaep = padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
         )
 
+        if isinstance(encrypted_data, dict):
+            # Unwrap the AES key with RSA, then open the AES-GCM body
+            aes_key = self.private_key.decrypt(base64.b64decode(encrypted_data['encrypted_key']), oaep)
+            decrypted = AESGCM(aes_key).decrypt(
+                base64.b64decode(encrypted_data['nonce']),
+                base64.b64decode(encrypted_data['ciphertext']),
+                None
+            )
+        else:
+            # RSA decryption with OAEP padding
+            decrypted = self.private_key.decrypt(base64.b64decode(encrypted_data), oaep)
+
         return json.loads(decrypted.decode())
 
+    def _start_session(self, session_key, session_channel, framing="json"):
+        """Store a new session key and prepare the cipher of the negotiated channel"""
+        self.session_key = session_key
+        self.session_channel = session_channel
+        self.session_aead = None
+        self.binary_framing = framing == "binary"
+
+        if session_channel == "gcm":
+            # Same HKDF derivation as the server, done once per session
+            key = HKDF(
+                algorithm=hashes.SHA256(),
+                length=32,
+                salt=None,
+                info=b"session-channel:gcm"
+            ).derive(session_key.encode())
+            self.session_aead = AESGCM(key)
+
+        logger.info(f"Session established using the {session_channel} channel and {framing} framing")
+
     def encrypt_with_session_key(self, data):
-        """Encrypt data with the session key using AES"""
+        """Encrypt data with the session key, base64-encoded for JSON bodies"""
+        return base64.b64encode(self.seal_with_session_key(data)).decode()
+
+    def seal_with_session_key(self, data):
+        """Encrypt data with the session key using AES into a raw frame"""
         if not self.session_key:
             raise Exception("Session key not established")
 
+        if self.session_aead:
+            # AES-GCM channel: version byte, nonce, then ciphertext with its tag
+            nonce = os.urandom(12)
+            ciphertext = self.session_aead.encrypt(nonce, json.dumps(data).encode(), None)
+            return bytes([2]) + nonce + ciphertext
+
         try:
             # Convert data to JSON and then to bytes
             plaintext = json.dumps(data).encode()
@@ -369,26 +459,30 @@ class MathDevice:
             # Encrypt the data
             ciphertext = encryptor.update(padded_data) + encryptor.finalize()
 
-            # Combine IV and ciphertext and encode to base64
-            encrypted = base64.b64encode(iv + ciphertext).decode()
-
-            return encrypted
+            # Combine IV and ciphertext
+            return iv + ciphertext
         except Exception as e:
             logger.error(f"Error encrypting with session key: {str(e)}")
             raise Exception(f"Error encrypting with session key: {str(e)}")
 
     def decrypt_with_session_key(self, encrypted_data):
-        """Decrypt data with the session key using AES"""
+        """Decrypt base64-encoded data from a JSON body with the session key"""
+        return self.open_with_session_key(base64.b64decode(encrypted_data))
+
+    def open_with_session_key(self, encrypted):
+        """Decrypt a raw frame with the session key using AES"""
         if not self.session_key:
             raise Exception("Session key not established")
 
+        if self.session_aead:
+            if encrypted[0] != 2:
+                raise Exception(f"Unsupported session channel version: {encrypted[0]}")
+            return json.loads(self.session_aead.decrypt(encrypted[1:13], encrypted[13:], None).decode())
+
         try:
             # Use only the first 32 bytes of the session key to match server
             key = self.session_key.encode()[:32]
 
-            # Decode from base64
-            encrypted = base64.b64decode(encrypted_data)
-
             # Extract IV and ciphertext
             iv = encrypted[:16]
             ciphertext = encrypted[16:]
@@ -427,7 +521,10 @@ class MathDevice:
                 f"{self.server_url}/reconnect-device/",
                 json={
                     "deviceId": self.device_id,
-                    "publicKey": self.public_key_pem
+                    "publicKey": self.public_key_pem,
+                    "responseEnvelope": "hybrid",
+                    "sessionChannels": ["gcm", "cbc"],
+                    "framings": ["binary", "json"]
                 }
             )
 
@@ -435,8 +532,13 @@ class MathDevice:
                 # Decrypt the response with our private key
                 decrypted_data = self.decrypt_with_private_key(response.json())
 
-                # Store the session key
-                self.session_key = decrypted_data["sessionKey"]
+                # Store the session key and the server's parameter table for our operations
+                self._start_session(
+                    decrypted_data["sessionKey"],
+                    decrypted_data.get("sessionChannel", "cbc"),
+                    decrypted_data.get("framing", "json")
+                )
+                self.action_parameters = decrypted_data.get("actions", {})
                 logger.info(f"Reconnection successful. Session key received.")
 
                 # Send an immediate heartbeat to ensure device is marked as active
@@ -476,7 +578,10 @@ class MathDevice:
                 },
                 "operations": list(self.operations.keys())  # The server maps this to capabilities
             },
-            "authToken": self.auth_token
+            "authToken": self.auth_token,
+            "responseEnvelope": "hybrid",
+            "sessionChannels": ["gcm", "cbc"],
+            "framings": ["binary", "json"]
         }
 
         # Encrypt the payload with the server's public key
@@ -506,8 +611,13 @@ class MathDevice:
                 # Decrypt the response with our private key
                 decrypted_data = self.decrypt_with_private_key(encrypted_response)
 
-                # Store the session key
-                self.session_key = decrypted_data["sessionKey"]
+                # Store the session key and the server's parameter table for our operations
+                self._start_session(
+                    decrypted_data["sessionKey"],
+                    decrypted_data.get("sessionChannel", "cbc"),
+                    decrypted_data.get("framing", "json")
+                )
+                self.action_parameters = decrypted_data.get("actions", {})
                 logger.info(f"Registration successful. Session key received.")
                 return True
             else:
@@ -525,23 +635,39 @@ class MathDevice:
             return []
 
         try:
+            headers = {"Accept": "application/octet-stream"} if self.binary_framing else {}
             response = requests.get(
-                f"{self.server_url}/devices/{self.device_id}/pending-commands"
+                f"{self.server_url}/devices/{self.device_id}/pending-commands",
+                params={"wait": self.long_poll_wait},
+                headers=headers,
+                timeout=self.long_poll_wait + 10
             )
 
+            if response.status_code == 200 and response.headers.get("Content-Type") == "application/octet-stream":
+                # Binary framing: the body is the encrypted frame, the wait comes in a header
+                self.long_poll_active = bool(float(response.headers.get("X-Long-Poll-Wait", 0)))
+                return self.open_with_session_key(response.content).get("commands", [])
+
             if response.status_code == 200:
+                response_data = response.json()
+
+                # Servers that support long polling echo the wait they applied
+                self.long_poll_active = bool(response_data.get("wait"))
+
                 # Check if response is encrypted
-                if "data" in response.json():
+                if "data" in response_data:
                     # Decrypt the data
-                    commands_data = self.decrypt_with_session_key(response.json()["data"])
+                    commands_data = self.decrypt_with_session_key(response_data["data"])
                     return commands_data.get("commands", [])
                 else:
                     # Fallback for unencrypted response
-                    return response.json().get("commands", [])
+                    return response_data.get("commands", [])
             else:
+                self.long_poll_active = False
                 logger.warning(f"Failed to get pending commands: {response.text}")
                 return []
         except Exception as e:
+            self.long_poll_active = False
             logger.error(f"Error getting pending commands: {str(e)}")
             return []
 
@@ -592,17 +718,25 @@ class MathDevice:
             return False
 
         try:
-            # Encrypt the result data
-            encrypted_data = self.encrypt_with_session_key(result)
-
-            # Send the result
-            response = requests.post(
-                f"{self.server_url}/commands/{command_id}/update",
-                json={
-                    "deviceId": self.device_id,
-                    "data": encrypted_data
-                }
-            )
+            # Encrypt the result data and send it
+            url = f"{self.server_url}/commands/{command_id}/update"
+            if self.binary_framing:
+                response = requests.post(
+                    url,
+                    data=self.seal_with_session_key(result),
+                    headers={
+                        "Content-Type": "application/octet-stream",
+                        "X-Device-Id": self.device_id
+                    }
+                )
+            else:
+                response = requests.post(
+                    url,
+                    json={
+                        "deviceId": self.device_id,
+                        "data": self.encrypt_with_session_key(result)
+                    }
+                )
 
             if response.status_code == 200:
                 logger.info(f"Result reported successfully")
@@ -632,30 +766,88 @@ class MathDevice:
         # Start the command polling loop in a separate thread
         threading.Thread(target=self._polling_loop, daemon=True).start()
 
-    def _polling_loop(self):
-        """Background thread for polling commands and sending heartbeats"""
-        heartbeat_interval = 15  # Send heartbeat every 15 seconds
-        last_heartbeat = 0
+    def _heartbeat_if_due(self, heartbeat_interval=15):
+        """Send a heartbeat every heartbeat_interval seconds"""
+        current_time = time.time()
+        if current_time - self.last_heartbeat >= heartbeat_interval:
+            self.send_heartbeat()
+            self.last_heartbeat = current_time
+
+    def _run_commands(self, commands):
+        """Execute each command and report results"""
+        for command in commands:
+            result = self.execute_command(command)
+            self.report_command_result(command["id"], result)
+
+    def stream_commands(self):
+        """Receive commands pushed over the server's event stream until it closes
+
+        Returns False if the stream could not be opened, so the caller falls
+        back to polling.
+        """
+        headers = {
+            "Accept": "text/event-stream",
+            # Proves we hold the session key; the server checks the timestamp is recent
+            "X-Device-Auth": self.encrypt_with_session_key({
+                "deviceId": self.device_id,
+                "timestamp": time.time()
+            })
+        }
 
-        while self.running:
-            try:
-                current_time = time.time()
+        try:
+            with requests.get(
+                f"{self.server_url}/async/devices/{self.device_id}/stream/",
+                headers=headers,
+                stream=True,
+                timeout=(10, 60)
+            ) as response:
+                if response.status_code != 200:
+                    logger.info(f"Command stream unavailable ({response.status_code}), polling instead")
+                    return False
 
-                # Send heartbeat if needed
-                if current_time - last_heartbeat >= heartbeat_interval:
-                    self.send_heartbeat()
-                    last_heartbeat = current_time
+                logger.info("Command stream connected")
+                event = None
+                for line in response.iter_lines(decode_unicode=True):
+                    if not self.running:
+                        break
 
-                # Get pending commands
-                commands = self.get_pending_commands()
+                    # Keepalives arrive every few seconds, so heartbeats stay on schedule
+                    self._heartbeat_if_due()
 
-                # Execute each command and report results
-                for command in commands:
-                    result = self.execute_command(command)
-                    self.report_command_result(command["id"], result)
+                    if line.startswith("event:"):
+                        event = line[len("event:"):].strip()
+                    elif line.startswith("data:") and event == "commands":
+                        commands_data = self.decrypt_with_session_key(line[len("data:"):].strip())
+                        self._run_commands(commands_data.get("commands", []))
+                    elif not line:
+                        event = None
+
+            logger.info("Command stream closed")
+            return True
+        except requests.RequestException as e:
+            logger.warning(f"Command stream failed: {str(e)}")
+            return False
 
-                # Sleep before polling again (shorter interval for better responsiveness)
-                time.sleep(5)
+    def _polling_loop(self):
+        """Background thread for receiving commands and sending heartbeats"""
+        while self.running:
+            try:
+                self._heartbeat_if_due()
+
+                # Prefer the push channel; poll while it is unavailable and retry it later
+                if self.use_command_stream and time.time() >= self.stream_retry_at:
+                    if self.stream_commands():
+                        time.sleep(1)  # Brief pause before reconnecting the stream
+                        continue
+                    self.stream_retry_at = time.time() + 60
+
+                # Get pending commands, execute them and report results
+                self._run_commands(self.get_pending_commands())
+
+                # The server already held the request open while long polling,
+                # otherwise sleep before polling again
+                if not self.long_poll_active:
+                    time.sleep(5)
             except Exception as e:
                 logger.error(f"Error in polling loop: {str(e)}")
                 time.sleep(10)  # Longer delay after error
@@ -716,11 +908,14 @@ def main():
                         default="calculator", help="Type of device to simulate")
     parser.add_argument("--token", required=True, help="Authorization token for device registration")
     parser.add_argument("--server", default="http://localhost:8000/api/", help="Server URL")
+    parser.add_argument("--no-stream", action="store_true",
+                        help="Poll for commands instead of using the server's event stream")
     args = parser.parse_args()
 
     try:
         # Create and start the device
         device = MathDevice(args.type, args.token, args.server)
+        device.use_command_stream = not args.no_stream
 
         # Set up signal handlers for graceful shutdown
         def signal_handler(sig, frame):
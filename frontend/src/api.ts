@@ -34,6 +34,29 @@ export interface Command {
   params: Record<string, any>;
   status: string;
   result: CommandResult | null;
+  priority: number;
+  deadline: string | null;
+  createdAt: string;
+  updatedAt: string;
+}
+
+// Delivery order and cut-off of a submitted command: higher priorities are
+// delivered first, and a command not delivered by its deadline fails
+export interface CommandScheduling {
+  priority?: number;
+  deadline?: string;
+}
+
+export interface Job {
+  id: string;
+  name: string;
+  createdBy: string | null;
+  total: number;
+  pending: number;
+  sent: number;
+  completed: number;
+  failed: number;
+  finished: boolean;
   createdAt: string;
   updatedAt: string;
 }
@@ -46,6 +69,27 @@ export interface Token {
 }
 
 
+// Filters and keyset pagination shared by the device and command listings
+export interface ListParams {
+  cursor?: string;
+  since?: string;
+  limit?: number;
+  status?: string;
+  name?: string;
+  device?: string;
+  job?: string;
+}
+
+// Change events pushed by the dashboard event stream
+export interface DeviceStatusEvent {
+  deviceId: string;
+  isActive: boolean;
+  lastSeen: string | null;
+}
+
+// New commands carry every Command field; status changes only id, status, updatedAt and result
+export type CommandEvent = Pick<Command, 'id' | 'status' | 'updatedAt'> & Partial<Command>;
+
 export interface CommandExecutionRequest {
   deviceId: string;
   command: string;
@@ -55,6 +99,7 @@ export interface CommandExecutionRequest {
 export interface CommandExecutionResponse {
   status: string;
   commandId: string;
+  deviceId: string;  // The device the command was assigned to
 }
 
 const API_URL = import.meta.env.VITE_API_URL || '/api/';
@@ -75,19 +120,24 @@ export default {
   },
 
   // Device operations
-  getDevices(): Promise<AxiosResponse<{ devices: Device[] }>> {
-    return axios.get(`${API_URL}devices/`);
+  getDevices(params?: ListParams): Promise<AxiosResponse<{ devices: Device[]; nextCursor: string | null }>> {
+    return axios.get(`${API_URL}devices/`, { params });
   },
 
   getDeviceCapabilities(deviceId: string): Promise<AxiosResponse<Device>> {
     return axios.get(`${API_URL}devices/${deviceId}/capabilities/`);
   },
 
-  getDeviceCommands(deviceId: string): Promise<AxiosResponse<{ commands: Command[] }>> {
-    return axios.get(`${API_URL}devices/${deviceId}/commands/`);
+  getDeviceCommands(deviceId: string, params?: ListParams): Promise<AxiosResponse<{ commands: Command[]; nextCursor: string | null }>> {
+    return axios.get(`${API_URL}devices/${deviceId}/commands/`, { params });
   },
-  getAllDevices() {
-  return axios.get(`${API_URL}devices/all/`);
+  getAllDevices(params?: ListParams): Promise<AxiosResponse<{
+    devices: Array<Device & { isActive: boolean }>;
+    nextCursor?: string | null;
+    deleted?: string[];
+    since: string;
+  }>> {
+    return axios.get(`${API_URL}devices/all/`, { params });
   },
   // Action operations
   getActionParameters(actionName: string): Promise<AxiosResponse<{
@@ -102,22 +152,73 @@ export default {
   executeCommand(
     deviceId: string,
     commandName: string,
-    params: Record<string, any>
+    params: Record<string, any>,
+    scheduling?: CommandScheduling
   ): Promise<AxiosResponse<CommandExecutionResponse>> {
     return axios.post(`${API_URL}execute-command/`, {
       deviceId,
       command: commandName,
-      params
+      params,
+      ...scheduling
+    });
+  },
+
+  // Let the server route the command to the least-loaded online device supporting it
+  executeCommandOnAnyDevice(
+    commandName: string,
+    params: Record<string, any>,
+    scheduling?: CommandScheduling
+  ): Promise<AxiosResponse<CommandExecutionResponse>> {
+    return axios.post(`${API_URL}execute-command/`, {
+      command: commandName,
+      params,
+      ...scheduling
     });
   },
 
+  // Queue one command on every online device matching the selector, or an explicit list of commands
+  executeCommandBatch(
+    batch: CommandScheduling & (
+      | { commands: ({ deviceId: string; command: string; params?: Record<string, any> } & CommandScheduling)[] }
+      | {
+          command: string;
+          params?: Record<string, any>;
+          selector: { deviceType?: string; capability?: string; all?: boolean };
+        }
+    )
+  ): Promise<AxiosResponse<{
+    status: string;
+    jobId: string;
+    count: number;
+    skipped?: number;
+    commandIds?: string[];
+  }>> {
+    return axios.post(`${API_URL}commands/batch/`, batch);
+  },
+
+  // Aggregate progress of a batch job
+  getJob(jobId: string): Promise<AxiosResponse<Job>> {
+    return axios.get(`${API_URL}jobs/${jobId}/`);
+  },
+
+  // Newline-delimited JSON export of a job's commands and results
+  getJobResults(jobId: string, status?: string): Promise<AxiosResponse<string>> {
+    return axios.get(`${API_URL}jobs/${jobId}/results/`, { params: { status }, responseType: 'text' });
+  },
+
   getCommandStatus(commandId: string): Promise<AxiosResponse<Command>> {
     return axios.get(`${API_URL}commands/${commandId}/status/`);
   },
 
   // Updated to use the new all commands endpoint
-  getAllCommands(): Promise<AxiosResponse<{ commands: Command[] }>> {
-    return axios.get(`${API_URL}commands/all/`);
+  // With params.since only the changed commands and the ids of deleted ones come back
+  getAllCommands(params?: ListParams): Promise<AxiosResponse<{
+    commands: Command[];
+    nextCursor?: string | null;
+    deleted?: string[];
+    since: string;
+  }>> {
+    return axios.get(`${API_URL}commands/all/`, { params });
   },
 
   // Token operations
@@ -137,6 +238,13 @@ export default {
     return axios.get(`${API_URL}server-key/`);
   },
 
+  // Live updates: 'device', 'command' and 'resync' server-sent events.
+  // EventSource cannot send headers, so the access token goes in the query string.
+  openEventStream(): EventSource {
+    const token = localStorage.getItem('user.access') || '';
+    return new EventSource(`${API_URL}async/events/?token=${encodeURIComponent(token)}`);
+  },
+
   // Device reconnection
   reconnectDevice(deviceId: string, publicKey: string): Promise<AxiosResponse<any>> {
     return axios.post(`${API_URL}reconnect-device/`, {